@@ -9,444 +9,1576 @@ Configuration (example):
 aurum2mqtt:
    device: 192.168.0.110                  # ip adress of the meetstekker
    broker: 192.168.0.111                  # ip adress of the MQTT broker
+   port: 1883                             # port of the MQTT broker, optional, default 1883
    password: mqtt_password                # MQTT broker password
    username: mqtt_user                    # MQTT username
-   select: [6,7,8,15,16,17,18,19,20,22]   # optional, example
+   select: [powerSolar, counterOutSolar, 15, 16]   # optional, tag names or positions in output.xml, example
    client: MQTT client-id                 # optional, default is 'aurum2mqtt'
-   scan_interval: 20                      # reporting interval, optional, default 60 seconds (note: the Dutch Smart Meter refreshes every 10 seoconds)
+   scan_interval: 20                      # reporting interval, optional, default 60 seconds (note: the Dutch Smart Meter refreshes every 10 seoconds,
+                                          # with a smart meter the polls are aligned to its telegrams)
+   timeout: 5                             # connect/read timeout for the meetstekker, optional, default 5 seconds
+   queue_size: 100                        # max. number of MQTT messages held while the broker is unreachable, optional, default 100
+   deadband: 0                            # publish only when a value moved more than this, optional, default 0 (any change)
+   deadband_percent: 0                    # same, relative to the last published value, optional, default 0
+   max_age: 300                           # republish unchanged values after this many seconds, optional, default 300
+   sensor_topics: false                   # also publish changed values to aurum/sensors/<tag>, optional, default false
+   encoding: json                         # json (one message for all sensors) or scalar (one topic per sensor, no templates), optional, default json
+   sensor_options:                        # retain and qos of the per-sensor topics, optional, default retain true and qos 0
+     powerMain: {retain: false, qos: 1}
+   max_parallel: 4                        # max. number of meetstekkers fetched at the same time, optional, default 4
+   log_timings: false                     # log the duration of every poll stage, optional, default false
+   buffer_size: 8640                      # readings kept on disk for backfill after a broker outage, optional, default 8640 (0 disables)
+   aggregates: [1, 15]                    # periods in minutes to publish min/max/mean power and energy for, optional, default none
+   mode: mqtt                             # mqtt, or native to create HA sensors directly without a broker, optional, default mqtt
+   max_counter_rate: 50                   # max. increase per hour of a counter (kWh or m3), optional, default 50
+   max_power: 50000                       # max. absolute power in W, optional, default 50000
+   limits:                                # per-sensor overrides of the above, optional
+     counterGas: {max_rate: 10}
+     powerMain: {min: -17000, max: 17000}
+
+With mode: native the broker options can be left out. The sensors are then
+created in HA directly and the MQTT-only options (sensor_topics, buffer_size,
+aggregates and the diagnostic sensors) are not used.
+
+Several meetstekkers can be polled by listing them under device, each with a
+unique name. The name is used in the topics (aurum/<name>/sensors), the
+unique_ids and the device in HA. The select option can be set per device:
+
+aurum2mqtt:
+   device:
+     - host: 192.168.0.110
+       name: house
+     - host: 192.168.0.120
+       name: barn
+       select: [powerSolar, counterOutSolar]
+   ...
    
 PLAN: change the code so that the sensors are autodiscovered by HA!
 
 """
+import asyncio
+import bisect
+import collections
+import importlib
 import logging
-from datetime import timedelta
+import math
+import mmap
+import os
+import struct
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
 
+import aiohttp
 import voluptuous as vol
 
-import urllib.request as ur
-import xml.etree.ElementTree as ET
-import paho.mqtt.publish as publish
-import paho.mqtt.client as mqtt
 import json
 
-from operator import itemgetter
-
 import homeassistant.helpers.config_validation as cv
 from homeassistant.const import (
-    CONF_DEVICE, CONF_PASSWORD, CONF_USERNAME, 
-    CONF_SCAN_INTERVAL, EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP)
-from homeassistant.helpers.event import async_track_time_interval
+    CONF_DEVICE, CONF_HOST, CONF_MODE, CONF_NAME, CONF_PASSWORD, CONF_PORT, CONF_USERNAME, 
+    CONF_SCAN_INTERVAL, CONF_TIMEOUT, EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP)
+from homeassistant.core import callback
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.discovery import async_load_platform
+from homeassistant.helpers.dispatcher import async_dispatcher_send
+from homeassistant.helpers.event import async_call_later
+from homeassistant.util import slugify
 
 __version__ = '0.2.4'
 
 _LOGGER = logging.getLogger(__name__)
 
-REGISTERED = 0
-
 CONF_BROKER = 'broker'
 CONF_CLIENT = 'client'
 CONF_LIST = 'select'
+CONF_QUEUE_SIZE = 'queue_size'
+CONF_DEADBAND = 'deadband'
+CONF_DEADBAND_PERCENT = 'deadband_percent'
+CONF_MAX_AGE = 'max_age'
+CONF_SENSOR_TOPICS = 'sensor_topics'
+CONF_ENCODING = 'encoding'
+CONF_SENSOR_OPTIONS = 'sensor_options'
+CONF_RETAIN = 'retain'
+CONF_QOS = 'qos'
+CONF_MAX_COUNTER_RATE = 'max_counter_rate'
+CONF_MAX_POWER = 'max_power'
+CONF_LIMITS = 'limits'
+CONF_MIN = 'min'
+CONF_MAX = 'max'
+CONF_MAX_RATE = 'max_rate'
+CONF_MAX_PARALLEL = 'max_parallel'
+CONF_LOG_TIMINGS = 'log_timings'
+CONF_BUFFER_SIZE = 'buffer_size'
+CONF_AGGREGATES = 'aggregates'
 
 DOMAIN = 'aurum2mqtt'
+MODE_MQTT = 'mqtt'
+MODE_NATIVE = 'native'
+ENCODING_JSON = 'json'
+ENCODING_SCALAR = 'scalar'
+
+# Dispatcher signals of a device in native mode, formatted with its prefix.
+SIGNAL_SENSORS = 'aurum2mqtt_sensors_{}'
+SIGNAL_VALUES = 'aurum2mqtt_values_{}'
 DEFAULT_CL = 'aurum2mqtt'
 DEFAULT_SELECT = list(range(23))
 
 SCAN_INTERVAL = timedelta(seconds=60)
+DEFAULT_PORT = 1883
+DEFAULT_TIMEOUT = 5
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_DEADBAND = 0
+DEFAULT_MAX_AGE = timedelta(seconds=300)
+DEFAULT_MAX_PARALLEL = 4
+# Max. seconds between the first polls of two devices after HA has started.
+FIRST_POLL_STAGGER = 2
+# Max. seconds the first polls wait for the connection to the MQTT broker.
+FIRST_POLL_CONNECT_TIMEOUT = 5
+# One day of readings at the 10 second telegram interval.
+DEFAULT_BUFFER_SIZE = 8640
+DEFAULT_MAX_COUNTER_RATE = 50
+DEFAULT_MAX_POWER = 50000
+# Readings in a row that confirm an implausible counter level as its new baseline, e.g. after a meter swap.
+CONFIRM_SAMPLES = 6
+# How far a counter may read below a baseline seeded from the retained state, which holds values rounded to 2 decimals.
+SEED_TOLERANCE = 0.005
+
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 120
+
+TIMESTAMP_TAG = 'smartMeterTimestamp'
+# The Dutch Smart Meter sends a telegram every 10 seconds.
+TELEGRAM_INTERVAL = 10
+# Phase search: the first probe step, the smallest step and the step back after a miss once converged.
+PHASE_STEP = TELEGRAM_INTERVAL / 4
+PHASE_MIN_STEP = 0.05
+PHASE_MISS_STEP = 0.5
+MAX_MISSES = 3
+MAX_BACKOFF = 600
+
+STATE_TOPIC = 'aurum/sensors'
+NAMED_STATE_TOPIC = 'aurum/{}/sensors'
+SENSOR_TOPIC = '{}/{}'
+DIAGNOSTICS_TOPIC = '{}/diagnostics'
+BACKFILL_TOPIC = '{}/backfill'
+AGGREGATE_TOPIC = '{}/aggregates/{}m'
+BUFFER_FILE = 'aurum2mqtt_{}.buf'
+DISCOVERY_TOPIC = 'homeassistant/sensor/{}/{}/config'
+BIRTH_TOPIC = 'homeassistant/status'
+BIRTH_PAYLOAD = 'online'
+
+DEVICE_INFO = {
+    'identifiers':'Aurum Meetstekker',
+    'name':'Aurum Meetstekker',
+    'model':'Meetstekker',
+    'manufacturer':'Aurum'
+}
+# The MQTT connection shared by all meetstekkers, which has diagnostic sensors of its own.
+HUB_PREFIX = 'aurum_mqtt'
+HUB_TOPIC = 'aurum'
+HUB_INFO = {
+    'identifiers':'Aurum MQTT connection',
+    'name':'Aurum MQTT connection',
+    'model':'aurum2mqtt',
+    'manufacturer':'Aurum'
+}
+
+# One row per sensor in the order the meetstekker reports them in output.xml:
+# (tag, name, unit, icon, device_class)
+SENSORS = (
+    ('powerBattery',              'aurum_battery_power',         'W',    'mdi:flash',    'power'),
+    ('counterOutBattery',         'aurum_battery_counter_out',   'kWh',  'mdi:flash',    'energy'),
+    ('counterInBattery',          'aurum_battery_counter_in',    'kWh',  'mdi:flash',    'energy'),
+    ('powerMCHP',                 'aurum_mchp_power',            'W',    'mdi:flash',    'power'),
+    ('counterOutMCHP',            'aurum_mchp_counter_out',      'kWh',  'mdi:flash',    'energy'),
+    ('counterInMCHP',             'aurum_mchp_counter_in',       'kWh',  'mdi:flash',    'energy'),
+    ('powerSolar',                'aurum_solar_power',           'W',    'mdi:flash',    'power'),
+    ('counterOutSolar',           'aurum_solar_counter_out',     'kWh',  'mdi:flash',    'energy'),
+    ('counterInSolar',            'aurum_solar_counter_in',      'kWh',  'mdi:flash',    'energy'),
+    ('powerEV',                   'aurum_EV_power',              'W',    'mdi:flash',    'power'),
+    ('counterOutEV',              'aurum_ev_counter_out',        'kWh',  'mdi:flash',    'energy'),
+    ('counterInEV',               'aurum_ev_counter_in',         'kWh',  'mdi:flash',    'energy'),
+    ('powerMain',                 'aurum_main_power',            'W',    'mdi:flash',    'power'),
+    ('counterOutMain',            'aurum_main_counter_out',      'kWh',  'mdi:flash',    'energy'),
+    ('counterInMain',             'aurum_main_counter_in',       'kWh',  'mdi:flash',    'energy'),
+    ('smartMeterTimestamp',       'aurum_smartmeter_timestamp',  '',     'mdi:av-timer', None),
+    ('powerElectricity',          'aurum_elec_power',            'W',    'mdi:flash',    'power'),
+    ('counterElectricityInLow',   'aurum_elec_counter_in_low',   'kWh',  'mdi:flash',    'energy'),
+    ('counterElectricityOutLow',  'aurum_elec_counter_out_low',  'kWh',  'mdi:flash',    'energy'),
+    ('counterElectricityInHigh',  'aurum_elec_counter_in_high',  'kWh',  'mdi:flash',    'energy'),
+    ('counterElectricityOutHigh', 'aurum_elec_counter_out_high', 'kWh',  'mdi:flash',    'energy'),
+    ('rateGas',                   'aurum_gas_rate',              'm3/h', 'mdi:fire',     None),
+    ('counterGas',                'aurum_gas_counter',           'm³',   'mdi:fire',     'gas'),
+)
+SENSOR_INFO = {row[0]: row for row in SENSORS}
+
+# The stages of a poll cycle and the counters kept per device, published as diagnostic sensors.
+STAGES = ('fetch', 'parse', 'serialize', 'publish', 'cycle')
+COUNTERS = ('fetch_failures', 'publish_failures', 'skipped_publishes', 'rejected_values', 'bytes_sent')
+# (key, unit, icon)
+DIAGNOSTICS = (
+    ('fetch_time',        'ms', 'mdi:timer-outline'),
+    ('parse_time',        'ms', 'mdi:timer-outline'),
+    ('serialize_time',    'ms', 'mdi:timer-outline'),
+    ('publish_time',      'ms', 'mdi:timer-outline'),
+    ('cycle_time',        'ms', 'mdi:timer-outline'),
+    ('fetch_failures',    '',   'mdi:alert-circle-outline'),
+    ('publish_failures',  '',   'mdi:alert-circle-outline'),
+    ('skipped_publishes', '',   'mdi:debug-step-over'),
+    ('rejected_values',   '',   'mdi:filter-remove-outline'),
+    ('bytes_sent',        'B',  'mdi:upload-network'),
+)
+# The counters of the shared MQTT connection.
+HUB_DIAGNOSTICS = (
+    ('mqtt_connections',  '',   'mdi:lan-connect'),
+)
+# Upper bounds in ms of the latency histogram buckets, the last bucket takes the rest.
+HISTOGRAM_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+HISTOGRAM_LABELS = tuple('le_{}ms'.format(bound) for bound in HISTOGRAM_BUCKETS) + (
+    'over_{}ms'.format(HISTOGRAM_BUCKETS[-1]),)
+STATS_WINDOW = 100
+DIAGNOSTICS_INTERVAL = 60
+
+# The aggregates published per power sensor and period: (key, unit, device_class)
+AGGREGATE_STATS = (
+    ('min',    'W',  'power'),
+    ('max',    'W',  'power'),
+    ('mean',   'W',  'power'),
+    ('energy', 'Wh', 'energy'),
+)
+
+# Bytes of output.xml handed to the parser at a time.
+PARSE_CHUNK = 1024
+
+# Readings per backfill message, the pause between two messages and how long to wait for the broker's acknowledgement.
+BACKFILL_BATCH = 30
+BACKFILL_DELAY = 0.5
+BACKFILL_ACK_TIMEOUT = 10
+
+def sensor_info(tag):
+   """Return the registry row for a tag, with a generic entry for tags unknown to this version."""
+   info = SENSOR_INFO.get(tag)
+   if info is None:
+      info = (tag, 'aurum_{}'.format(tag), '', 'mdi:flash', None)
+   return info
+
+def discovery_payload(tag, prefix='aurum', state_topic=STATE_TOPIC, device_info=DEVICE_INFO, scalar=False, qos=0):
+   """Return the serialized MQTT discovery config for a sensor of the device with the given prefix.
+
+   With scalar the sensor reads its own topic below state_topic, which holds
+   the bare value, so no template is needed.
+   """
+   tag, name, unit, icon, device_class = sensor_info(tag)
+   payload = {
+       'name':prefix + name[len('aurum'):],
+       'unit_of_meas':unit,
+       'value_template':'{{ value_json.%s }}' % tag,
+       'icon':icon,
+       'state_topic':state_topic,
+       'unique_id':'{}_{}_sensor'.format(prefix, tag),
+       'device':device_info
+   }
+   if scalar:
+      del payload['value_template']
+      payload['state_topic'] = SENSOR_TOPIC.format(state_topic, tag)
+   if qos:
+      payload['qos'] = qos
+   if device_class is not None:
+      payload['device_class'] = device_class
+   return json.dumps(payload, separators=(',', ':'))
+
+def diagnostic_payload(key, unit, icon, prefix, state_topic, device_info):
+   """Return the serialized MQTT discovery config for a diagnostic sensor of a device."""
+   topic = DIAGNOSTICS_TOPIC.format(state_topic)
+   payload = {
+       'name':'{}_{}'.format(prefix, key),
+       'unit_of_meas':unit,
+       'value_template':'{{ value_json.%s }}' % key,
+       'icon':icon,
+       'state_topic':topic,
+       'unique_id':'{}_{}_diagnostic'.format(prefix, key),
+       'entity_category':'diagnostic',
+       'device':device_info
+   }
+   stage = key[:-len('_time')]
+   if stage in STAGES:
+      payload['json_attributes_topic'] = topic
+      payload['json_attributes_template'] = '{{ value_json.histograms.%s | tojson }}' % stage
+   return json.dumps(payload, separators=(',', ':'))
+
+def aggregate_payload(tag, period, stat, prefix, state_topic, device_info):
+   """Return the serialized MQTT discovery config for an aggregate of a power sensor."""
+   key, unit, device_class = next(row for row in AGGREGATE_STATS if row[0] == stat)
+   tag, name, _, icon, _ = sensor_info(tag)
+   return json.dumps({
+       'name':'{}{}_{}m_{}'.format(prefix, name[len('aurum'):], period, stat),
+       'unit_of_meas':unit,
+       'value_template':'{{ value_json.%s.%s }}' % (tag, stat),
+       'icon':icon,
+       'state_topic':AGGREGATE_TOPIC.format(state_topic, period),
+       'unique_id':'{}_{}_{}m_{}'.format(prefix, tag, period, stat),
+       'device_class':device_class,
+       'device':device_info
+   }, separators=(',', ':'))
+
+def state_payload(values):
+   """Serialize a {tag: value} mapping to the JSON state message, keeping values numeric."""
+   return json.dumps(
+       {tag: None if value is None else round(value, 2) for tag, value in values.items()},
+       separators=(',', ':'))
+
+def state_value(value):
+   """Serialize a single numeric value as a raw scalar payload."""
+   return str(round(value, 2))
+
+def resolve_select(select, layout, warn=True):
+   """Map the configured select list to the set of tag names to publish.
+
+   Integers are positions in the layout (the tags in the order the device
+   reports them), strings are tag names. Items the device does not report are
+   skipped, with a warning when warn is set.
+   """
+   tags = set()
+   for item in select:
+      if isinstance(item, int):
+         if item < len(layout):
+            tags.add(layout[item])
+         elif warn:
+            _LOGGER.warning("Selected position %d is not reported by the meetstekker", item)
+      elif item in layout:
+         tags.add(item)
+      elif warn:
+         _LOGGER.warning("Selected sensor %s is not reported by the meetstekker", item)
+   return frozenset(tags)
+
+def parse_output(body, tags=None, layout=None):
+   """Parse output.xml into a {tag: value} mapping.
+
+   The body is fed to a pull parser PARSE_CHUNK bytes at a time and the events
+   are handled after every chunk. Each sensor element is dropped from the root
+   once its value has been read, so the tree never holds more than the
+   elements of one chunk. Only the value attribute of the root's children is
+   read, limited to tags when given; other tags are skipped before any
+   conversion. Values that are not finite numbers map to None. When a layout
+   list is passed, every tag is appended to it in document order.
+   """
+   parser = ET.XMLPullParser(events=('start', 'end'))
+
+   def events():
+      for offset in range(0, len(body), PARSE_CHUNK):
+         parser.feed(body[offset:offset + PARSE_CHUNK])
+         yield from parser.read_events()
+      parser.close()
+      yield from parser.read_events()
+
+   values = {}
+   root = None
+   depth = 0
+   for event, elem in events():
+      if event == 'start':
+         depth += 1
+         if depth == 1:
+            root = elem
+         if depth != 2:
+            continue
+         if layout is not None:
+            layout.append(elem.tag)
+         if tags is None or elem.tag in tags:
+            try:
+               value = float(elem.get('value'))
+            except (TypeError, ValueError):
+               value = None
+            # C's %f prints nan and inf, which are no readings either.
+            values[elem.tag] = value if value is not None and math.isfinite(value) else None
+      else:
+         depth -= 1
+         if depth == 1:
+            root.remove(elem)
+   return values
+
+def has_broker(conf):
+   """Validate that the broker options are set unless the sensors are created natively."""
+   if conf[CONF_MODE] == MODE_MQTT:
+      for key in (CONF_BROKER, CONF_USERNAME, CONF_PASSWORD):
+         if key not in conf:
+            raise vol.Invalid('{} is required in {} mode'.format(key, MODE_MQTT), path=[key])
+   return conf
+
+def has_unique_names(devices):
+   """Validate that several devices can be told apart by their names."""
+   if len(devices) > 1:
+      names = [slugify(device.get(CONF_NAME, '')) for device in devices]
+      if '' in names or len(set(names)) != len(names):
+         raise vol.Invalid('each device needs a unique name when more than one is configured')
+   return devices
+
+SENSOR_OPTIONS_SCHEMA = vol.Schema({
+    cv.string: vol.Schema({
+        vol.Optional(CONF_RETAIN, default=True): cv.boolean,
+        vol.Optional(CONF_QOS, default=0): vol.All(vol.Coerce(int), vol.In([0, 1, 2])),
+    }),
+})
+
+LIMITS_SCHEMA = vol.Schema({
+    cv.string: vol.Schema({
+        vol.Optional(CONF_MIN): vol.Coerce(float),
+        vol.Optional(CONF_MAX): vol.Coerce(float),
+        vol.Optional(CONF_MAX_RATE): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    }),
+})
+
+SELECT_SCHEMA = vol.All(cv.ensure_list, [vol.Any(cv.positive_int, cv.string)])
+
+DEVICE_SCHEMA = vol.Schema({
+    vol.Required(CONF_HOST): cv.string,
+    vol.Optional(CONF_NAME): cv.string,
+    vol.Optional(CONF_LIST): SELECT_SCHEMA,
+})
 
 CONFIG_SCHEMA = vol.Schema({
-    DOMAIN: vol.Schema({
-        vol.Required(CONF_DEVICE): cv.string,
-        vol.Required(CONF_BROKER): cv.string,
-        vol.Required(CONF_USERNAME): cv.string,
-        vol.Required(CONF_PASSWORD): cv.string,
-        vol.Optional(CONF_LIST, default=DEFAULT_SELECT): vol.All(cv.ensure_list, [cv.positive_int]),
+    DOMAIN: vol.All(vol.Schema({
+        vol.Required(CONF_DEVICE): vol.All(
+            cv.ensure_list,
+            [vol.Any(DEVICE_SCHEMA, vol.All(cv.string, lambda host: {CONF_HOST: host}))],
+            has_unique_names),
+        vol.Optional(CONF_MODE, default=MODE_MQTT): vol.In([MODE_MQTT, MODE_NATIVE]),
+        vol.Optional(CONF_BROKER): cv.string,
+        vol.Optional(CONF_PORT, default=DEFAULT_PORT): cv.port,
+        vol.Optional(CONF_USERNAME): cv.string,
+        vol.Optional(CONF_PASSWORD): cv.string,
+        vol.Optional(CONF_LIST): SELECT_SCHEMA,
         vol.Optional(CONF_CLIENT, default=DEFAULT_CL): cv.string,
         vol.Optional(CONF_SCAN_INTERVAL, default=SCAN_INTERVAL):
             cv.time_period,
-    }),
+        vol.Optional(CONF_TIMEOUT, default=DEFAULT_TIMEOUT): cv.positive_int,
+        vol.Optional(CONF_QUEUE_SIZE, default=DEFAULT_QUEUE_SIZE):
+            vol.All(vol.Coerce(int), vol.Range(min=1)),
+        vol.Optional(CONF_DEADBAND, default=DEFAULT_DEADBAND):
+            vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_DEADBAND_PERCENT, default=DEFAULT_DEADBAND):
+            vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_MAX_AGE, default=DEFAULT_MAX_AGE): cv.time_period,
+        vol.Optional(CONF_SENSOR_TOPICS, default=False): cv.boolean,
+        vol.Optional(CONF_ENCODING, default=ENCODING_JSON): vol.In([ENCODING_JSON, ENCODING_SCALAR]),
+        vol.Optional(CONF_SENSOR_OPTIONS, default={}): SENSOR_OPTIONS_SCHEMA,
+        vol.Optional(CONF_MAX_COUNTER_RATE, default=DEFAULT_MAX_COUNTER_RATE):
+            vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_MAX_POWER, default=DEFAULT_MAX_POWER): vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_LIMITS, default={}): LIMITS_SCHEMA,
+        vol.Optional(CONF_MAX_PARALLEL, default=DEFAULT_MAX_PARALLEL):
+            vol.All(vol.Coerce(int), vol.Range(min=1)),
+        vol.Optional(CONF_LOG_TIMINGS, default=False): cv.boolean,
+        vol.Optional(CONF_BUFFER_SIZE, default=DEFAULT_BUFFER_SIZE):
+            vol.All(vol.Coerce(int), vol.Range(min=0)),
+        vol.Optional(CONF_AGGREGATES, default=[]):
+            vol.All(cv.ensure_list, [vol.All(vol.Coerce(int), vol.Range(min=1, max=1440))]),
+    }), has_broker),
 }, extra=vol.ALLOW_EXTRA)
 
+def telegram_time(value):
+   """Convert a smartMeterTimestamp value to seconds, None when there is no smart meter.
+
+   The meetstekker reports either the DSMR form YYMMDDhhmmss or seconds since the epoch.
+   """
+   if not value:
+      return None
+   if value >= 1e11:
+      try:
+         return datetime.strptime('%012d' % value, '%y%m%d%H%M%S').timestamp()
+      except ValueError:
+         return None
+   return value
+
+class PollScheduler:
+   """Works out when a device should be polled next.
+
+   With a smart meter the polls are aligned to its telegrams. The lag between
+   a telegram's timestamp and the moment output.xml shows it is learnt from
+   smartMeterTimestamp: after a poll that found a new telegram the next one is
+   tried a step earlier, after a poll that was too early it is retried a step
+   later, halving the step until it is small. Without a smart meter the scan
+   interval is used. After failed fetches the delay backs off exponentially.
+
+   The aligned polls are made offset seconds after the learnt moment, so
+   devices that share a smart meter's phase keep their stagger.
+   """
+
+   def __init__(self, scan_interval):
+      self.interval = scan_interval
+      self.offset = 0
+      self._telegrams = max(1, round(scan_interval / TELEGRAM_INTERVAL))
+      self.failures = 0
+      self._timestamp = None
+      self._reset()
+
+   def _reset(self):
+      self._expected = None
+      self._lag = None
+      self._step = PHASE_STEP
+      self._misses = 0
+
+   def failed(self):
+      """Register a failed fetch and return the delay until the next attempt."""
+      self.failures += 1
+      return min(self.interval * 2 ** (self.failures - 1), MAX_BACKOFF)
+
+   def polled(self, started, timestamp):
+      """Register a poll started at wall-clock time started.
+
+      Returns whether the response carries a new telegram and the delay until the next poll.
+      """
+      self.failures = 0
+      telegram = telegram_time(timestamp)
+      if telegram is None:
+         return True, self.interval
+      fresh = telegram != self._timestamp
+      self._timestamp = telegram
+      if self._expected is not None and telegram < self._expected:
+         # Polled before the expected telegram was readable.
+         if self._misses >= MAX_MISSES:
+            # The meter stopped sending telegrams, learn the phase again once it is back.
+            self._reset()
+            return fresh, self.interval
+         self._misses += 1
+         step = self._step if self._step > PHASE_MIN_STEP else PHASE_MISS_STEP
+         self._step = max(self._step / 2, PHASE_MIN_STEP)
+         self._lag += step
+         return fresh, step
+      sample = started - self.offset - telegram
+      if self._lag is None or sample - self._lag > TELEGRAM_INTERVAL:
+         # First telegram or a clock jump.
+         self._lag = sample
+      else:
+         self._lag = min(self._lag, sample) - self._step
+      self._misses = 0
+      self._expected = telegram + self._telegrams * TELEGRAM_INTERVAL
+      now = time.time()
+      while self._expected + self._lag + self.offset <= now:
+         self._expected += TELEGRAM_INTERVAL
+      return fresh, self._expected + self._lag + self.offset - now
+
+class CycleStats:
+   """Per-stage timings of the recent poll cycles of a device and its counters."""
+
+   def __init__(self):
+      self.current = {}
+      self.counters = dict.fromkeys(COUNTERS, 0)
+      self._recent = {stage: collections.deque(maxlen=STATS_WINDOW) for stage in STAGES}
+      self._histograms = {stage: [0] * len(HISTOGRAM_LABELS) for stage in STAGES}
+
+   def timed(self, stage, seconds):
+      """Record the duration of a stage of the current cycle."""
+      ms = seconds * 1000
+      self.current[stage] = ms
+      self._recent[stage].append(ms)
+      self._histograms[stage][bisect.bisect_left(HISTOGRAM_BUCKETS, ms)] += 1
+
+   def count(self, counter, amount=1):
+      self.counters[counter] += amount
+
+   def payload(self):
+      """Serialize the median timing per stage over the recent cycles, the counters and the histograms."""
+      data = {}
+      for stage in STAGES:
+         recent = sorted(self._recent[stage])
+         data[stage + '_time'] = round(recent[len(recent) // 2], 2) if recent else None
+      data.update(self.counters)
+      data['histograms'] = {
+          stage: dict(zip(HISTOGRAM_LABELS, counts)) for stage, counts in self._histograms.items()}
+      return json.dumps(data, separators=(',', ':'))
+
+class RingBuffer:
+   """Fixed-size file of sample records that overwrites the oldest record when full.
+
+   The file is memory mapped. Every record holds a flag that is set while it
+   waits to be sent to the broker, a timestamp and one double per known
+   sensor, NaN when the sensor was not read. The header keeps the next write
+   position, the number of records, the number of pending records and the
+   position from where to look for them.
+   """
+
+   HEADER = struct.Struct('<4sIIIIII')
+   FLAG = struct.Struct('<?')
+   MAGIC = b'AUR2'
+
+   def __init__(self, path, capacity, tags):
+      self._path = path
+      self._capacity = capacity
+      self._tags = tags
+      self._record = struct.Struct('<?{}d'.format(len(tags) + 1))
+      self._file = None
+      self._map = None
+      self._head = 0
+      self._count = 0
+      # All pending records are between _first and _head.
+      self._first = 0
+      self.pending = 0
+
+   def open(self):
+      """Open or create the file, starting over when its layout does not match. Blocking."""
+      size = self.HEADER.size + self._capacity * self._record.size
+      mode = 'r+b' if os.path.exists(self._path) else 'w+b'
+      self._file = open(self._path, mode)
+      if os.fstat(self._file.fileno()).st_size != size:
+         self._file.truncate(size)
+      self._map = mmap.mmap(self._file.fileno(), size)
+      magic, capacity, slots, head, count, pending, first = self.HEADER.unpack_from(self._map)
+      if magic == self.MAGIC and capacity == self._capacity and slots == len(self._tags):
+         self._head, self._count, self.pending, self._first = head, count, pending, first
+      else:
+         self._write_header()
+
+   def close(self):
+      """Flush and close the file. Blocking."""
+      if self._map is not None:
+         self._map.flush()
+         self._map.close()
+         self._file.close()
+         self._map = self._file = None
+
+   def _write_header(self):
+      self.HEADER.pack_into(
+          self._map, 0, self.MAGIC, self._capacity, len(self._tags), self._head, self._count, self.pending,
+          self._first)
+
+   def _offset(self, index):
+      return self.HEADER.size + index % self._capacity * self._record.size
+
+   def append(self, timestamp, values, pending):
+      """Store a sample, marking it as waiting for the broker when pending."""
+      if self._count == self._capacity:
+         # The oldest record is overwritten.
+         if self.FLAG.unpack_from(self._map, self._offset(self._head))[0]:
+            self.pending -= 1
+         if self._first == self._head:
+            self._first = (self._head + 1) % self._capacity
+      if pending:
+         if not self.pending:
+            self._first = self._head
+         self.pending += 1
+      self._record.pack_into(
+          self._map, self._offset(self._head), pending, timestamp,
+          *(math.nan if values.get(tag) is None else values[tag] for tag in self._tags))
+      self._head = (self._head + 1) % self._capacity
+      self._count = min(self._count + 1, self._capacity)
+      self._write_header()
+
+   def _read(self, index):
+      _, timestamp, *row = self._record.unpack_from(self._map, self._offset(index))
+      return timestamp, {tag: value for tag, value in zip(self._tags, row) if not math.isnan(value)}
+
+   def _pending_indices(self, limit):
+      """Return the positions of up to limit of the oldest pending records."""
+      indices = []
+      wanted = min(limit, self.pending)
+      span = (self._head - self._first) % self._capacity or self._capacity
+      for index in range(self._first, self._first + span):
+         if len(indices) == wanted:
+            break
+         if self.FLAG.unpack_from(self._map, self._offset(index))[0]:
+            indices.append(index % self._capacity)
+      return indices
+
+   def last(self):
+      """Return the newest sample as a (timestamp, {tag: value}) pair, None when the file is empty."""
+      return self._read(self._head - 1) if self._count else None
+
+   def peek_pending(self, limit):
+      """Return up to limit of the oldest pending samples as (timestamp, {tag: value}) pairs."""
+      return [self._read(index) for index in self._pending_indices(limit)]
+
+   def mark_sent(self, number):
+      """Drop the oldest number of samples from the pending ones."""
+      indices = self._pending_indices(number)
+      for index in indices:
+         self.FLAG.pack_into(self._map, self._offset(index), False)
+      self.pending -= len(indices)
+      if indices:
+         self._first = (indices[-1] + 1) % self._capacity
+      self._write_header()
+
+class Aggregate:
+   """Min, max, time-weighted mean and trapezoidal energy of a power sensor over fixed windows.
+
+   Windows are aligned to multiples of the period. Only running totals are
+   kept, the segment that crosses a window boundary is split at the boundary.
+   The interpolated value at the boundary counts towards the min and max of
+   both windows, as the mean and energy include it too.
+   """
+
+   __slots__ = ('_period', '_start', '_last', '_min', '_max', '_sum', '_count', '_area', '_covered')
+
+   def __init__(self, period):
+      self._period = period
+      self._start = None
+      self._last = None
+      self._reset()
+
+   def _reset(self):
+      self._min = math.inf
+      self._max = -math.inf
+      self._sum = 0.0
+      self._count = 0
+      self._area = 0.0
+      self._covered = 0.0
+
+   def _integrate(self, t, value):
+      last_t, last_value = self._last
+      self._area += (last_value + value) / 2 * (t - last_t)
+      self._covered += t - last_t
+      self._min = min(self._min, value)
+      self._max = max(self._max, value)
+
+   def _summary(self):
+      if not self._count:
+         return None
+      mean = self._area / self._covered if self._covered else self._sum / self._count
+      return {
+          'min':round(self._min, 2),
+          'max':round(self._max, 2),
+          'mean':round(mean, 2),
+          'energy':round(self._area / 3600, 3)}
+
+   def add(self, t, value):
+      """Add a sample taken at t seconds, returning the summary of the window it closed, if any."""
+      if self._last is not None and t <= self._last[0]:
+         return None
+      window = t - t % self._period
+      summary = None
+      if self._start is not None and window != self._start:
+         end = self._start + self._period
+         boundary = None
+         if self._last is not None and window == end:
+            last_t, last_value = self._last
+            boundary = (end, last_value + (value - last_value) * (end - last_t) / (t - last_t))
+            self._integrate(*boundary)
+         summary = self._summary()
+         self._reset()
+         self._last = boundary
+         if boundary is not None:
+            self._min = self._max = boundary[1]
+      self._start = window
+      if self._last is not None:
+         self._integrate(t, value)
+      self._last = (t, value)
+      self._min = min(self._min, value)
+      self._max = max(self._max, value)
+      self._sum += value
+      self._count += 1
+      return summary
+
+class Aggregator:
+   """Aggregates of the power sensors of a device over the configured periods."""
+
+   def __init__(self, periods):
+      self.periods = periods
+      self._aggregates = {}
+
+   @staticmethod
+   def applies(tag):
+      return sensor_info(tag)[4] == 'power'
+
+   def add(self, t, values):
+      """Feed a sample, returning {period: {tag: summary}} for the windows it closed."""
+      closed = {}
+      for tag, value in values.items():
+         if value is None or not self.applies(tag):
+            continue
+         for period in self.periods:
+            aggregate = self._aggregates.get((tag, period))
+            if aggregate is None:
+               aggregate = self._aggregates[(tag, period)] = Aggregate(period * 60)
+            summary = aggregate.add(t, value)
+            if summary is not None:
+               closed.setdefault(period, {})[tag] = summary
+      return closed
+
+class Validator:
+   """Plausibility rules per sensor, rejected values are held back and counted.
+
+   Counters must not go down nor rise faster than their max rate per hour,
+   power values must stay within their bounds and neither may be missing. A
+   counter reading of zero or less is rejected once the counter has a
+   positive baseline; before that it belongs to an unused input and is
+   passed on without becoming the baseline. A rejected value is replaced by
+   the last accepted one. A counter that keeps reporting a consistent new
+   level for CONFIRM_SAMPLES readings is accepted from there on. The counters
+   can be seeded with the values accepted before a restart, so a bad first
+   reading is not taken as the baseline.
+   """
+
+   def __init__(self, max_counter_rate, max_power, limits):
+      self._max_counter_rate = max_counter_rate
+      self._max_power = max_power
+      self._limits = limits
+      self._accepted = {}
+      self._candidates = {}
+      # How far the counters seeded from rounded values may read below their baseline.
+      self._tolerance = {}
+      self.rejected = 0
+
+   def _counter_ok(self, tag, last, t, value, tolerance=0):
+      last_t, last_value = last
+      max_rate = self._limits.get(tag, {}).get(CONF_MAX_RATE, self._max_counter_rate)
+      return last_value - tolerance <= value <= last_value + max_rate * max(t - last_t, 1) / 3600
+
+   def seed(self, t, values, tolerance=0):
+      """Take counter values accepted at t as the baseline of the counters that have none yet.
+
+      With a tolerance the first reading may be that much lower, for values
+      that were rounded.
+      """
+      for tag, value in values.items():
+         if tag.startswith('counter') and value is not None and value > 0 and tag not in self._accepted:
+            self._accepted[tag] = (t, value)
+            if tolerance:
+               self._tolerance[tag] = tolerance
+
+   def _plausible(self, tag, t, value):
+      if tag.startswith('counter'):
+         if value is None:
+            return False
+         last = self._accepted.get(tag)
+         if value <= 0:
+            # A P1 dropout or a meetstekker that just booted, never a new level of a counter that had one.
+            return last is None
+         if last is None or self._counter_ok(tag, last, t, value, self._tolerance.get(tag, 0)):
+            self._candidates.pop(tag, None)
+            return True
+         candidate = self._candidates.get(tag)
+         if candidate is not None and self._counter_ok(tag, candidate[:2], t, value):
+            candidate = (t, value, candidate[2] + 1)
+         else:
+            candidate = (t, value, 1)
+         if candidate[2] < CONFIRM_SAMPLES:
+            self._candidates[tag] = candidate
+            return False
+         _LOGGER.warning("Accepting %s as new level of %s after %d readings", value, tag, CONFIRM_SAMPLES)
+         del self._candidates[tag]
+         return True
+      if sensor_info(tag)[4] == 'power':
+         limits = self._limits.get(tag, {})
+         return value is not None and (
+             limits.get(CONF_MIN, -self._max_power) <= value <= limits.get(CONF_MAX, self._max_power))
+      return True
+
+   def check(self, t, values):
+      """Return the values with the implausible ones replaced by the last accepted values."""
+      checked = {}
+      for tag, value in values.items():
+         if self._plausible(tag, t, value):
+            if not (tag.startswith('counter') and value <= 0):
+               self._accepted[tag] = (t, value)
+               self._tolerance.pop(tag, None)
+            checked[tag] = value
+            continue
+         self.rejected += 1
+         _LOGGER.debug("Rejected implausible value %s of %s", value, tag)
+         last = self._accepted.get(tag)
+         if last is not None:
+            checked[tag] = last[1]
+      return checked
+
+class ChangeFilter:
+   """Per-sensor change detection with a deadband and a max-age heartbeat."""
+
+   def __init__(self, deadband, deadband_percent, max_age):
+      self._deadband = deadband
+      self._ratio = deadband_percent / 100
+      self._max_age = max_age
+      self._last = {}
+
+   def reset(self):
+      """Forget what was published, so every value is sent again."""
+      self._last.clear()
+
+   def _moved(self, last, value):
+      """Return True when value is outside the deadband around the last published value."""
+      if last is None or value is None:
+         return last is not value
+      return abs(value - last) > max(self._deadband, abs(last) * self._ratio)
+
+   def changed(self, values, now):
+      """Return the values that should be published and remember them as published."""
+      changed = {}
+      for tag, value in values.items():
+         last = self._last.get(tag)
+         if last is None or self._moved(last[0], value) or now - last[1] >= self._max_age:
+            changed[tag] = value
+            self._last[tag] = (value, now)
+      return changed
+
+def publish_hub_diagnostics(mqtt_client):
+   """Send the counters of the shared MQTT connection and their discovery configs, retained."""
+   for key, unit, icon in HUB_DIAGNOSTICS:
+      mqtt_client.publish(
+          DISCOVERY_TOPIC.format(HUB_PREFIX, key),
+          diagnostic_payload(key, unit, icon, HUB_PREFIX, HUB_TOPIC, HUB_INFO), retain=True)
+   payload = json.dumps({'mqtt_connections': mqtt_client.connections}, separators=(',', ':'))
+   mqtt_client.publish(DIAGNOSTICS_TOPIC.format(HUB_TOPIC), payload, retain=True)
+
+class AurumMqttClient:
+   """Long-lived MQTT connection with a bounded outbound queue.
+
+   The paho network loop runs in its own thread and reconnects with backoff.
+   Messages are queued from the event loop and drained whenever the broker
+   is connected; when the queue is full the oldest message is dropped. A
+   message queued with publish_confirmed resolves its future once the broker
+   acknowledged it, or with False when it was dropped or the connection was
+   lost first. A message queued with the CycleStats of a device counts as
+   that device's bytes_sent once it is handed to paho, and as one of its
+   publish_failures when it is dropped. paho is only imported when the client
+   is started.
+   """
+
+   def __init__(self, hass, broker, port, auth, client_id, keepalive, queue_size):
+      self._hass = hass
+      self._broker = broker
+      self._port = port
+      self._auth = auth
+      self._client_id = client_id
+      self._keepalive = keepalive
+      self._queue = collections.deque(maxlen=queue_size)
+      self._wakeup = asyncio.Event()
+      self._connected = asyncio.Event()
+      self._drain_task = None
+      self._connect_listeners = []
+      self._subscriptions = {}
+      # Futures of the confirmed messages handed to paho, by message id.
+      self._unacked = {}
+      self.connections = 0
+      # The paho.mqtt.client module and the client, once started.
+      self._paho = None
+      self._client = None
+
+   def _on_connect(self, client, userdata, flags, rc, properties=None):
+      """Called from the paho thread when the broker accepts the connection."""
+      mqtt = self._paho
+      if rc != mqtt.CONNACK_ACCEPTED:
+         _LOGGER.error("MQTT broker %s refused the connection: %s", self._broker, mqtt.connack_string(rc))
+         return
+      _LOGGER.debug("Connected to MQTT broker %s", self._broker)
+      self.connections += 1
+      for topic in list(self._subscriptions):
+         client.subscribe(topic)
+      self._hass.loop.call_soon_threadsafe(self._connection_made)
+
+   def _on_message(self, client, userdata, msg):
+      """Called from the paho thread for every message on a subscribed topic."""
+      self._hass.loop.call_soon_threadsafe(self._message_received, msg.topic, msg.payload)
+
+   @callback
+   def _message_received(self, topic, payload):
+      payload = payload.decode('utf-8', 'replace')
+      for listener in list(self._subscriptions.get(topic, ())):
+         listener(payload)
+
+   def subscribe(self, topic, listener):
+      """Call listener in the event loop with the payload of every message on topic."""
+      self._subscriptions.setdefault(topic, []).append(listener)
+      if self.connected:
+         self._client.subscribe(topic)
+
+   def unsubscribe(self, topic, listener):
+      """Stop calling listener for topic, unsubscribing from the broker when it was the last one."""
+      listeners = self._subscriptions.get(topic, [])
+      if listener in listeners:
+         listeners.remove(listener)
+      if not listeners:
+         self._subscriptions.pop(topic, None)
+         if self.connected:
+            self._client.unsubscribe(topic)
+
+   @callback
+   def _connection_made(self):
+      self._connected.set()
+      for listener in self._connect_listeners:
+         listener()
+
+   @property
+   def connected(self):
+      return self._connected.is_set()
+
+   async def async_wait_connected(self, timeout):
+      """Wait up to timeout seconds for the broker, returning whether it is connected."""
+      try:
+         await asyncio.wait_for(self._connected.wait(), timeout)
+      except asyncio.TimeoutError:
+         return False
+      return True
+
+   def add_connect_listener(self, listener):
+      """Call listener in the event loop every time the connection to the broker is (re)established."""
+      self._connect_listeners.append(listener)
+
+   def _on_disconnect(self, client, userdata, flags, rc, properties=None):
+      """Called from the paho thread when the connection is lost or closed."""
+      if rc != self._paho.MQTT_ERR_SUCCESS:
+         _LOGGER.warning("Lost connection to MQTT broker %s, reconnecting", self._broker)
+      self._hass.loop.call_soon_threadsafe(self._connection_lost)
+
+   @callback
+   def _connection_lost(self):
+      self._connected.clear()
+      unacked, self._unacked = self._unacked, {}
+      for future in unacked.values():
+         if not future.done():
+            future.set_result(False)
+
+   def _on_publish(self, client, userdata, mid, rc=None, properties=None):
+      """Called from the paho thread when a message was sent, for QoS 1 once the broker acknowledged it."""
+      self._hass.loop.call_soon_threadsafe(self._published, mid)
+
+   @callback
+   def _published(self, mid):
+      future = self._unacked.pop(mid, None)
+      if future is not None and not future.done():
+         future.set_result(True)
+
+   async def async_start(self):
+      """Import paho, connect in the background and start draining the queue."""
+      self._paho = mqtt = await self._hass.async_add_executor_job(importlib.import_module, 'paho.mqtt.client')
+      if hasattr(mqtt, 'CallbackAPIVersion'):
+         self._client = mqtt.Client(
+             mqtt.CallbackAPIVersion.VERSION2, client_id=self._client_id, protocol=mqtt.MQTTv311)
+         self._client.on_disconnect = self._on_disconnect
+      else:
+         # paho < 2 only has the version 1 callbacks, on_disconnect gets no flags there.
+         self._client = mqtt.Client(client_id=self._client_id, protocol=mqtt.MQTTv311)
+         self._client.on_disconnect = lambda client, userdata, rc: self._on_disconnect(client, userdata, None, rc)
+      self._client.username_pw_set(self._auth['username'], self._auth['password'])
+      self._client.reconnect_delay_set(min_delay=RECONNECT_MIN_DELAY, max_delay=RECONNECT_MAX_DELAY)
+      self._client.on_connect = self._on_connect
+      self._client.on_message = self._on_message
+      self._client.on_publish = self._on_publish
+      self._client.connect_async(self._broker, self._port, self._keepalive)
+      self._client.loop_start()
+      self._drain_task = self._hass.loop.create_task(self._async_drain())
+
+   async def async_stop(self):
+      """Flush what can still be sent, then disconnect and stop the network loop."""
+      if self._client is None:
+         return
+      if self._drain_task is not None:
+         self._drain_task.cancel()
+         self._drain_task = None
+      if self._connected.is_set():
+         self._send_queued()
+      self._client.disconnect()
+      await self._hass.async_add_executor_job(self._client.loop_stop)
+
+   def _enqueue(self, message, future=None, stats=None):
+      if len(self._queue) == self._queue.maxlen:
+         topic, _, _, _, dropped, owner = self._queue[0]
+         _LOGGER.debug("MQTT queue full, dropping oldest message for %s", topic)
+         if dropped is not None and not dropped.done():
+            dropped.set_result(False)
+         if owner is not None:
+            owner.count('publish_failures')
+      self._queue.append(message + (future, stats))
+
+   def publish(self, topic, payload, qos=0, retain=False, stats=None):
+      """Queue a message for the broker."""
+      self._enqueue((topic, payload, qos, retain), stats=stats)
+      self._wakeup.set()
+
+   def publish_confirmed(self, topic, payload, qos=1, retain=False, stats=None):
+      """Queue a message, returning a future that is set to whether the broker acknowledged it."""
+      future = self._hass.loop.create_future()
+      self._enqueue((topic, payload, qos, retain), future, stats)
+      self._wakeup.set()
+      return future
+
+   def publish_many(self, messages, stats=None):
+      """Queue (topic, payload, qos, retain) messages, to be flushed to the broker in one pass."""
+      for message in messages:
+         self._enqueue(message, stats=stats)
+      self._wakeup.set()
+
+   def _send_queued(self):
+      """Hand queued messages to paho until the queue is empty or a publish fails."""
+      mqtt = self._paho
+      while self._queue:
+         topic, payload, qos, retain, future, stats = self._queue[0]
+         info = self._client.publish(topic, payload, qos=qos, retain=retain)
+         if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            _LOGGER.debug("Publish to %s failed (%s), keeping it queued", topic, mqtt.error_string(info.rc))
+            return False
+         self._queue.popleft()
+         if future is not None:
+            self._unacked[info.mid] = future
+         if stats is not None:
+            stats.count('bytes_sent', len(payload))
+      return True
+
+   async def _async_drain(self):
+      """Send queued messages whenever there are any and the broker is connected."""
+      while True:
+         await self._wakeup.wait()
+         await self._connected.wait()
+         self._wakeup.clear()
+         if not self._send_queued():
+            # Give paho time to notice the disconnect before retrying.
+            self._wakeup.set()
+            await asyncio.sleep(RECONNECT_MIN_DELAY)
+
+class AurumDevice:
+   """A meetstekker with its own topics, discovery configs and poll state.
+
+   Without an MQTT client (native mode) the values are handed to the entities
+   of the sensor platform through the dispatcher instead.
+   """
+
+   def __init__(self, hass, conf, options, session, mqtt_client, semaphore):
+      self._hass = hass
+      self.host = conf[CONF_HOST]
+      name = conf.get(CONF_NAME)
+      if name is None:
+         self.prefix = 'aurum'
+         self.state_topic = STATE_TOPIC
+         self.device_info = DEVICE_INFO
+      else:
+         slug = slugify(name)
+         title = 'Aurum Meetstekker {}'.format(name)
+         self.prefix = 'aurum_{}'.format(slug)
+         self.state_topic = NAMED_STATE_TOPIC.format(slug)
+         self.device_info = dict(DEVICE_INFO, identifiers=title, name=title)
+      self._select = conf.get(CONF_LIST, options.get(CONF_LIST))
+      # Only an explicitly configured select warns about sensors the device lacks.
+      self._select_configured = self._select is not None
+      if self._select is None:
+         self._select = DEFAULT_SELECT
+      self._scalar = options[CONF_ENCODING] == ENCODING_SCALAR
+      self._sensor_topics = self._scalar or options[CONF_SENSOR_TOPICS]
+      self._sensor_options = options[CONF_SENSOR_OPTIONS]
+      self._timings_level = logging.INFO if options[CONF_LOG_TIMINGS] else logging.DEBUG
+      self._stats = CycleStats()
+      self._diagnostics_sent = None
+      self._buffer = None
+      if mqtt_client is not None and options[CONF_BUFFER_SIZE]:
+         self._buffer = RingBuffer(
+             hass.config.path('.storage', BUFFER_FILE.format(self.prefix)), options[CONF_BUFFER_SIZE],
+             tuple(SENSOR_INFO))
+      self._backfilling = False
+      self._aggregator = None
+      if mqtt_client is not None and options[CONF_AGGREGATES]:
+         self._aggregator = Aggregator(options[CONF_AGGREGATES])
+      self._session = session
+      self._mqtt = mqtt_client
+      self._semaphore = semaphore
+      self._url = 'http://{}/measurements/output.xml'.format(self.host)
+      timeout = options[CONF_TIMEOUT]
+      self._timeout = aiohttp.ClientTimeout(connect=timeout, sock_read=timeout)
+      self._validator = Validator(options[CONF_MAX_COUNTER_RATE], options[CONF_MAX_POWER], options[CONF_LIMITS])
+      self._change_filter = ChangeFilter(
+          options[CONF_DEADBAND], options[CONF_DEADBAND_PERCENT], options[CONF_MAX_AGE].total_seconds())
+      self._discovery = {}
+      # The discovery config last sent per topic, an empty string for removed sensors.
+      self._announced = {}
+      self._announce_needed = True
+      # The tag layout of the last response and the selected tags resolved from it.
+      self._layout = None
+      self._selected = None
+      # The selected tags in layout order and their last values, for the native entities.
+      self.sensors = ()
+      self.values = {}
+      self._scheduler = PollScheduler(options[CONF_SCAN_INTERVAL].total_seconds())
+      self._in_flight = set()
+      self._unsub = None
+      self._stopped = False
+
+   async def async_open(self):
+      """Listen for HA birth messages, open the reading buffer and backfill from it on every connect.
+
+      The counters are checked against the newest buffered reading, or else the
+      retained state message, from before the restart.
+      """
+      if self._mqtt is None:
+         return
+      self._mqtt.subscribe(BIRTH_TOPIC, self._birth_received)
+      last = None
+      if self._buffer is not None:
+         await self._hass.async_add_executor_job(self._buffer.open)
+         last = self._buffer.last()
+         self._mqtt.add_connect_listener(self._start_backfill)
+         if self._mqtt.connected:
+            self._start_backfill()
+      if last is not None:
+         self._validator.seed(*last)
+      elif not self._scalar:
+         self._mqtt.subscribe(self.state_topic, self._retained_state_received)
+
+   @callback
+   def _retained_state_received(self, payload):
+      """Seed the counters from the first state message, which is the retained one from before the restart."""
+      self._mqtt.unsubscribe(self.state_topic, self._retained_state_received)
+      try:
+         values = json.loads(payload)
+      except ValueError:
+         return
+      if isinstance(values, dict):
+         # The time of the message is unknown, so the rate is not limited.
+         self._validator.seed(
+             0, {tag: value for tag, value in values.items() if isinstance(value, (int, float))}, SEED_TOLERANCE)
+
+   def close(self):
+      """Close the reading buffer. Blocking."""
+      if self._buffer is not None:
+         self._buffer.close()
+
+   def start(self, delay):
+      """Start polling, the first time after delay seconds.
+
+      The telegram-aligned polls keep the same offset.
+      """
+      self._scheduler.offset = delay
+      self._schedule(delay)
+
+   def _schedule(self, delay):
+      """Poll again after delay seconds."""
+      @callback
+      def _poll(now):
+         self._unsub = None
+         self._hass.async_create_task(self.async_update())
+
+      self._unsub = async_call_later(self._hass, delay, _poll)
+
+   def stop(self):
+      """Stop polling and cancel a fetch that is still in flight."""
+      self._stopped = True
+      if self._unsub is not None:
+         self._unsub()
+         self._unsub = None
+      for task in list(self._in_flight):
+         task.cancel()
+
+   def _discovery_payload(self, tag):
+      """Return the discovery config for a tag of this device, serialized on first use."""
+      payload = self._discovery.get(tag)
+      if payload is None:
+         payload = self._discovery[tag] = discovery_payload(
+             tag, self.prefix, self.state_topic, self.device_info, self._scalar, self._topic_options(tag)[1])
+      return payload
+
+   async def async_fetch(self):
+      """Fetch output.xml from the meetstekker without blocking the event loop."""
+      async with self._semaphore:
+         start = time.monotonic()
+         async with self._session.get(self._url, timeout=self._timeout) as response:
+            response.raise_for_status()
+            body = await response.read()
+      self._stats.timed('fetch', time.monotonic() - start)
+      return body
+
+   def parse(self, body):
+      """Parse a response into the selected values and the smart meter timestamp.
+
+      The selection is re-resolved when the tag layout changed.
+      """
+      start = time.monotonic()
+      layout = []
+      values = parse_output(body, None if self._selected is None else self._selected | {TIMESTAMP_TAG}, layout)
+      layout = tuple(layout)
+      if layout != self._layout:
+         if self._layout is not None:
+            _LOGGER.info("The meetstekker at %s reports a different set of sensors", self.host)
+         self._announce_needed = True
+         self._layout = layout
+         self._selected = resolve_select(self._select, layout, self._select_configured)
+         values = parse_output(body, self._selected | {TIMESTAMP_TAG})
+      if TIMESTAMP_TAG in self._selected:
+         timestamp = values.get(TIMESTAMP_TAG)
+      else:
+         timestamp = values.pop(TIMESTAMP_TAG, None)
+      self._stats.timed('parse', time.monotonic() - start)
+      return values, timestamp
+
+   def _topic_options(self, tag):
+      """Return retain and qos of the own topic of a sensor."""
+      options = self._sensor_options.get(tag)
+      if options is None:
+         return True, 0
+      return options[CONF_RETAIN], options[CONF_QOS]
+
+   def _send(self, topic, payload, retain=True, qos=0):
+      """Queue a message, counted in the diagnostics of this device."""
+      self._mqtt.publish(topic, payload, qos=qos, retain=retain, stats=self._stats)
+
+   def _send_batch(self, messages):
+      """Queue (topic, payload, qos, retain) messages as one batch, counted in the diagnostics of this device."""
+      self._mqtt.publish_many(messages, self._stats)
+
+   @callback
+   def _birth_received(self, payload):
+      """Announce everything again when HA (re)connects to the broker, retained messages may be gone."""
+      if payload != BIRTH_PAYLOAD:
+         return
+      _LOGGER.debug("HA came online, announcing the sensors of %s again", self.host)
+      self._announced = {}
+      self._change_filter.reset()
+      if self._layout is not None:
+         self.announce()
+
+   def announce(self):
+      """Send the discovery configs that differ from what was last sent, in one batch.
+
+      Sensors that are not selected, or no longer reported, get an empty
+      retained config so HA removes them.
+      """
+      configs = {
+          DISCOVERY_TOPIC.format(self.prefix, tag): self._discovery_payload(tag) if tag in self._selected else ''
+          for tag in self._layout}
+      if self._aggregator is not None:
+         for tag in self._layout:
+            if tag not in self._selected or not self._aggregator.applies(tag):
+               continue
+            for period in self._aggregator.periods:
+               for stat, _, _ in AGGREGATE_STATS:
+                  configs[DISCOVERY_TOPIC.format(self.prefix, '{}_{}m_{}'.format(tag, period, stat))] = \
+                      aggregate_payload(tag, period, stat, self.prefix, self.state_topic, self.device_info)
+      for key, unit, icon in DIAGNOSTICS:
+         configs[DISCOVERY_TOPIC.format(self.prefix, key)] = diagnostic_payload(
+             key, unit, icon, self.prefix, self.state_topic, self.device_info)
+      for topic in self._announced:
+         configs.setdefault(topic, '')
+      changed = [(topic, payload) for topic, payload in configs.items() if self._announced.get(topic) != payload]
+      for topic, payload in changed:
+         self._send(topic, payload)
+      _LOGGER.debug("Sent %d discovery configs for %s", len(changed), self.host)
+      self._announced = configs
+      self._announce_needed = False
+
+   def publish(self, values):
+      """Send discovery when needed and the state of the values that changed."""
+      if self._mqtt is None:
+         self.publish_native(values)
+         return
+      if self._announce_needed:
+         self.announce()
+      changed = self._change_filter.changed(values, time.monotonic())
+      if not changed:
+         self._stats.count('skipped_publishes')
+         _LOGGER.debug("No changed values from %s, skipping publish", self.host)
+         return
+      start = time.monotonic()
+      messages = []
+      if not self._scalar:
+         # The combined message always carries every selected value, the templates of unchanged sensors read it too.
+         messages.append((self.state_topic, state_payload(values), 0, True))
+      if self._sensor_topics:
+         for parameter, value in changed.items():
+            if value is None:
+               # An empty retained payload would delete the last state on the broker.
+               continue
+            retain, qos = self._topic_options(parameter)
+            messages.append((SENSOR_TOPIC.format(self.state_topic, parameter), state_value(value), qos, retain))
+      serialized = time.monotonic()
+      self._stats.timed('serialize', serialized - start)
+      self._send_batch(messages)
+      self._stats.timed('publish', time.monotonic() - serialized)
+
+   def publish_native(self, values):
+      """Hand the values that changed to the entities of the sensor platform."""
+      if self._announce_needed:
+         self.sensors = tuple(tag for tag in self._layout if tag in self._selected)
+         async_dispatcher_send(self._hass, SIGNAL_SENSORS.format(self.prefix), self.sensors)
+         self._announce_needed = False
+      changed = self._change_filter.changed(values, time.monotonic())
+      self.values = values
+      if not changed:
+         self._stats.count('skipped_publishes')
+         return
+      start = time.monotonic()
+      async_dispatcher_send(self._hass, SIGNAL_VALUES.format(self.prefix), changed)
+      self._stats.timed('publish', time.monotonic() - start)
+
+   def aggregate(self, timestamp, values):
+      """Feed a sample to the aggregates and publish the windows it closed."""
+      if self._aggregator is None:
+         return
+      closed = self._aggregator.add(telegram_time(timestamp) or time.time(), values)
+      for period, summaries in closed.items():
+         self._send(AGGREGATE_TOPIC.format(self.state_topic, period), json.dumps(summaries, separators=(',', ':')))
+
+   def buffer(self, timestamp, values):
+      """Store a sample in the reading buffer, pending for the backfill when the broker is unreachable.
+
+      A backfill that stopped early is started again once the broker is back.
+      """
+      if self._buffer is None:
+         return
+      connected = self._mqtt.connected
+      self._buffer.append(telegram_time(timestamp) or time.time(), values, not connected)
+      if self._buffer.pending and connected:
+         self._start_backfill()
+
+   @callback
+   def _start_backfill(self):
+      if self._buffer.pending and not self._backfilling:
+         self._backfilling = True
+         self._hass.async_create_task(self.async_backfill())
+
+   async def async_backfill(self):
+      """Send the readings buffered during a broker outage in rate-limited batches.
+
+      A batch stays pending until the broker acknowledged it. When it was
+      dropped, the connection was lost or no acknowledgement came in time, the
+      backfill stops and starts over from that batch later.
+      """
+      _LOGGER.info("Backfilling %d readings of %s", self._buffer.pending, self.host)
+      topic = BACKFILL_TOPIC.format(self.state_topic)
+      try:
+         while self._buffer.pending and self._mqtt.connected and not self._stopped:
+            samples = self._buffer.peek_pending(BACKFILL_BATCH)
+            payload = json.dumps(
+                [dict(values, timestamp=timestamp) for timestamp, values in samples], separators=(',', ':'))
+            acked = self._mqtt.publish_confirmed(topic, payload, qos=1, stats=self._stats)
+            try:
+               if not await asyncio.wait_for(acked, BACKFILL_ACK_TIMEOUT):
+                  break
+            except asyncio.TimeoutError:
+               _LOGGER.debug("No acknowledgement of the backfill of %s, retrying later", self.host)
+               break
+            if self._stopped:
+               # The buffer may be closed by now, the batch is sent again after a restart.
+               break
+            self._buffer.mark_sent(len(samples))
+            await asyncio.sleep(BACKFILL_DELAY)
+      finally:
+         self._backfilling = False
+
+   def publish_diagnostics(self):
+      """Log the stage timings of the last cycle and send the diagnostics once per DIAGNOSTICS_INTERVAL."""
+      current = self._stats.current
+      if _LOGGER.isEnabledFor(self._timings_level):
+         _LOGGER.log(self._timings_level, "Poll cycle of %s: %s", self.host, ', '.join(
+             '{} {:.1f} ms'.format(stage, current[stage]) for stage in STAGES if stage in current))
+      self._stats.current = {}
+      now = time.monotonic()
+      if self._mqtt is not None and self._announced and (self._diagnostics_sent is None or now - self._diagnostics_sent >= DIAGNOSTICS_INTERVAL):
+         self._diagnostics_sent = now
+         self._stats.counters['rejected_values'] = self._validator.rejected
+         self._mqtt.publish(DIAGNOSTICS_TOPIC.format(self.state_topic), self._stats.payload(), qos=0, retain=False)
+
+   async def async_poll(self):
+      """Get the topics from the AURUM API and send them to the MQTT Broker.
+
+      Returns the delay until the next poll.
+      """
+      task = asyncio.current_task()
+      self._in_flight.add(task)
+      delay = self._scheduler.interval
+      start = time.monotonic()
+      try:
+         started = time.time()
+         values, timestamp = self.parse(await self.async_fetch())
+      except (aiohttp.ClientError, asyncio.TimeoutError, ET.ParseError) as exception:
+         self._stats.count('fetch_failures')
+         delay = self._scheduler.failed()
+         if self._scheduler.failures == 1:
+            _LOGGER.error("Unable to fetch data from AURUM at %s. %s", self.host, exception)
+         else:
+            _LOGGER.debug("Still unable to fetch data from AURUM at %s, retrying in %d s. %s",
+                          self.host, delay, exception)
+      else:
+         if self._scheduler.failures:
+            _LOGGER.info("Fetching data from AURUM at %s works again", self.host)
+         fresh, delay = self._scheduler.polled(started, timestamp)
+         if not fresh:
+            self._stats.count('skipped_publishes')
+            _LOGGER.debug("No new telegram from %s yet, skipping publish", self.host)
+         else:
+            values = self._validator.check(telegram_time(timestamp) or time.time(), values)
+            self.aggregate(timestamp, values)
+            self.buffer(timestamp, values)
+            self.publish(values)
+         self._stats.timed('cycle', time.monotonic() - start)
+      finally:
+         self._in_flight.discard(task)
+         if not self._stopped:
+            self.publish_diagnostics()
+      return delay
+
+   async def async_update(self):
+      """Poll and schedule the next poll."""
+      delay = self._scheduler.interval
+      try:
+         delay = await self.async_poll()
+      finally:
+         if not self._stopped:
+            self._schedule(delay)
+
 async def async_setup(hass, config):
-   """Initialize the AURUM MQTT consumer"""
+   """Initialize the AURUM MQTT consumer
+
+   Nothing is fetched or connected here; the first poll and the MQTT
+   connection are started once HA has started, so setup stays off the boot path.
+   """
+   setup_start = time.monotonic()
    conf = config[DOMAIN]
-   device = conf.get(CONF_DEVICE)
+   native = conf.get(CONF_MODE) == MODE_NATIVE
    broker = conf.get(CONF_BROKER)
    username = conf.get(CONF_USERNAME)
    password = conf.get(CONF_PASSWORD)
-   select = conf.get(CONF_LIST)
    client = conf.get(CONF_CLIENT)
-   scan_interval = conf.get(CONF_SCAN_INTERVAL)
+   scan_interval = conf.get(CONF_SCAN_INTERVAL).total_seconds()
+   queue_size = conf.get(CONF_QUEUE_SIZE)
+   timings_level = logging.INFO if conf.get(CONF_LOG_TIMINGS) else logging.DEBUG
 
    client_id = client
    auth = {'username':username, 'password':password}
-   port = 1883
+   port = conf.get(CONF_PORT)
    keepalive = 300
 
-   async def async_get_aurum_data(event_time):   
-      """Get the topics from the AURUM API and send to the MQTT Broker."""
-      payload_powerBattery = {
-                     'name':'aurum_battery_power',
-                     'unit_of_meas':'W',
-                     'value_template':'{{ value_json.powerBattery }}',
-                     'icon':'mdi:flash',
-                     'state_topic':'aurum/sensors',
-                     'unique_id':'aurum_powerBattery_sensor',
-                     'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterOutBattery = {
-                     'name':'aurum_battery_counter_out',
-                     'unit_of_meas':'kWh',
-                     'value_template':'{{ value_json.counterOutBattery }}',
-                     'icon':'mdi:flash',
-                     'state_topic':'aurum/sensors',
-                     'unique_id':'aurum_counterOutBattery_sensor',
-                     'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-
-      payload_counterInBattery = {
-                     'name':'aurum_battery_counter_in',
-                     'unit_of_meas':'kWh',
-                     'value_template':'{{ value_json.counterInBattery }}',
-                     'icon':'mdi:flash',
-                     'state_topic':'aurum/sensors',
-                     'unique_id':'aurum_counterInBattery_sensor',
-                     'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_powerMCHP = {
-                     'name':'aurum_mchp_power',
-                     'unit_of_meas':'W',
-                     'value_template':'{{ value_json.powerMCHP }}',
-                     'icon':'mdi:flash',
-                     'state_topic':'aurum/sensors',
-                     'unique_id':'aurum_powerMCHP_sensor',
-                     'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterOutMCHP = {
-                     'name':'aurum_mchp_counter_out',
-                     'unit_of_meas':'kWh',
-                     'value_template':'{{ value_json.counterOutMCHP }}',
-                     'icon':'mdi:flash',
-                     'state_topic':'aurum/sensors',
-                     'unique_id':'aurum_counterOutMCHP_sensor',
-                     'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterInMCHP = {
-                     'name':'aurum_mchp_counter_in',
-                     'unit_of_meas':'kWh',
-                     'value_template':'{{ value_json.counterInMCHP }}',
-                     'icon':'mdi:flash',
-                     'state_topic':'aurum/sensors',
-                     'unique_id':'aurum_counterInMCHP_sensor',
-                     'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_powerSolar = {
-                     'name':'aurum_solar_power',
-                     'unit_of_meas':'W',
-                     'value_template':'{{ value_json.powerSolar }}',
-                     'icon':'mdi:flash',
-                     'state_topic':'aurum/sensors',
-                     'unique_id':'aurum_powerSolar_sensor',
-                     'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterOutSolar = {
-                     'name':'aurum_solar_counter_out',
-                     'unit_of_meas':'kWh',
-                     'value_template':'{{ value_json.counterOutSolar }}',
-                     'icon':'mdi:flash',
-                     'state_topic':'aurum/sensors',
-                     'unique_id':'aurum_counterOutSolar_sensor',
-                     'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterInSolar = {
-                     'name':'aurum_solar_counter_in',
-                     'unit_of_meas':'kWh',
-                     'value_template':'{{ value_json.counterInSolar }}',
-                     'icon':'mdi:flash',
-                     'state_topic':'aurum/sensors',
-                     'unique_id':'aurum_counterInSolar_sensor',
-                     'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_powerEV = {
-                     'name':'aurum_EV_power',
-                     'unit_of_meas':'W',
-                     'value_template':'{{ value_json.powerEV }}',
-                     'icon':'mdi:flash',
-                     'state_topic':'aurum/sensors',
-                     'unique_id':'aurum_powerEV_sensor',
-                     'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterOutEV = {
-                      'name':'aurum_ev_counter_out',
-                      'unit_of_meas':'kWh',
-                      'value_template':'{{ value_json.counterOutEV }}',
-                      'icon':'mdi:flash',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_counterOutEV_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterInEV = {
-                      'name':'aurum_ev_counter_in',
-                      'unit_of_meas':'kWh',
-                      'value_template':'{{ value_json.counterInEV }}',
-                      'icon':'mdi:flash',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_counterInEV_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }      
-      payload_powerMain = {
-                      'name':'aurum_main_power',
-                      'unit_of_meas':'W',
-                      'value_template':'{{ value_json.powerMain }}',
-                      'icon':'mdi:flash',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_powerMain_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterOutMain = {
-                      'name':'aurum_main_counter_out',
-                      'unit_of_meas':'kWh',
-                      'value_template':'{{ value_json.counterOutMain }}',
-                      'icon':'mdi:flash',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_counterOutMain_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterInMain = {
-                      'name':'aurum_main_counter_in',
-                      'unit_of_meas':'kWh',
-                      'value_template':'{{ value_json.counterInMain }}',
-                      'icon':'mdi:flash',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_counterInMain_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_smartMeterTimestamp = {
-                      'name':'aurum_smartmeter_timestamp',
-                      "unit_of_meas":"",
-                      'value_template':'{{ value_json.smartMeterTimestamp }}',
-                      'icon':'mdi:av-timer',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_smartMeterTimestamp_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }          
-      payload_powerElectricity = {
-                      'name':'aurum_elec_power',
-                      'unit_of_meas':'W',
-                      'value_template':'{{ value_json.powerElectricity }}',
-                      'icon':'mdi:flash',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_powerElectricity_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterElectricityInLow = {
-                      'name':'aurum_elec_counter_in_low',
-                      'unit_of_meas':'kWh',
-                      'value_template':'{{ value_json.counterElectricityInLow }}',
-                      'icon':'mdi:flash',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_counterElectricityInLow_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterElectricityOutLow = {
-                      'name':'aurum_elec_counter_out_low',
-                      'unit_of_meas':'kWh',
-                      'value_template':'{{ value_json.counterElectricityOutLow }}',
-                      'icon':'mdi:flash',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_counterElectricityOutLow_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                     }
-      payload_counterElectricityInHigh = {
-                      'name':'aurum_elec_counter_in_high',
-                      'unit_of_meas':'kWh',
-                      'value_template':'{{ value_json.counterElectricityInHigh }}',
-                      'icon':'mdi:flash',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_counterElectricityInHigh_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterElectricityOutHigh = {
-                      'name':'aurum_elec_counter_out_high',
-                      'unit_of_meas':'kWh',
-                      'value_template':'{{ value_json.counterElectricityOutHigh }}',
-                      'icon':'mdi:flash',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_counterElectricityOutHigh_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                     }
-      payload_rateGas = {
-                      'name':'aurum_gas_rate',
-                      'unit_of_meas':'m3/h',
-                      'value_template':'{{ value_json.rateGas }}',
-                      'icon':'mdi:fire',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_rateGas_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                    }
-      payload_counterGas = {
-                      'name':'aurum_gas_counter',
-                      'unit_of_meas':'m3',
-                      'value_template':'{{ value_json.counterGas }}',
-                      'icon':'mdi:fire',
-                      'state_topic':'aurum/sensors',
-                      'unique_id':'aurum_counterGas_sensor',
-                      'device':{
-                              'identifiers':'Aurum Meetstekker',
-                              'name':'Aurum Meetstekker',
-                              'model':'Meetstekker',
-                              'manufacturer':'Aurum'
-                              }
-                     }
-      global REGISTERED
-      try:
-         url = 'http://{}/measurements/output.xml'.format(device)
-         tree = ET.parse(ur.urlopen(url))
-         root = tree.getroot()
-      except Exception as exception:
-         _LOGGER.error("Unable to fetch data from AURUM. %s", exception)    
-      else:
-         if REGISTERED == 0:
-            x = 0
-            for child in root:
-               if(child is not None):
-                  parameter = child.tag
-                  payload = "payload_"+str(parameter)
-                  payload = locals()[payload]
-                  payload = json.dumps(payload)
-                  payload = payload.replace(": ", ":")
-                  if x in select:
-                     publish.single('homeassistant/sensor/aurum/{}/config'.format(parameter), payload, qos=0, retain=True, hostname=broker, port=port, auth=auth, client_id=client, protocol=mqtt.MQTTv311)
-                  x = x+1
-         REGISTERED = 1
-         data=[]
-         for child in root:
-            if(child is not None):
-               parameter = child.tag
-               value = child.get('value')
-               try:
-                  value = float(value)
-                  value = round(value, 2)
-                  value = str(value)
-               except:
-                  pass
-               j_str = json.dumps({parameter:value})
-               j_str = j_str.replace('{"', "").replace('"}', "").replace('"', "")
-               data.append(j_str)
-         data = itemgetter(*select)(data)
-         mqtt_message = json.dumps(data)
-         payload = mqtt_message.replace("[", "{").replace("]", "}").replace(': ', '":"')
-         publish.single('aurum/sensors', payload, qos=0, retain=True, hostname=broker, port=port, auth=auth, client_id=client, protocol=mqtt.MQTTv311)
-
-   async_track_time_interval(hass, async_get_aurum_data, scan_interval)
+   mqtt_client = None
+   if not native:
+      mqtt_client = AurumMqttClient(hass, broker, port, auth, client_id, keepalive, queue_size)
+      mqtt_client.add_connect_listener(lambda: publish_hub_diagnostics(mqtt_client))
+
+   # The shared HA session keeps the connections to the meetstekkers alive between polls.
+   session = async_get_clientsession(hass)
+   semaphore = asyncio.Semaphore(conf.get(CONF_MAX_PARALLEL))
+   devices = [
+       AurumDevice(hass, device_conf, conf, session, mqtt_client, semaphore)
+       for device_conf in conf.get(CONF_DEVICE)]
+   hass.data[DOMAIN] = devices
+   if native:
+      hass.async_create_task(async_load_platform(hass, 'sensor', DOMAIN, {}, config))
+
+   async def async_start_aurum(event):
+      """Connect to the broker and start polling, the devices a few seconds apart.
+
+      The first polls wait a moment for the broker, so their readings are
+      published right away instead of being buffered for the backfill.
+      """
+      start = time.monotonic()
+      if mqtt_client is not None:
+         await mqtt_client.async_start()
+      for device in devices:
+         await device.async_open()
+      if mqtt_client is not None and not await mqtt_client.async_wait_connected(FIRST_POLL_CONNECT_TIMEOUT):
+         _LOGGER.warning("MQTT broker %s is not connected yet, polling anyway", broker)
+      # Spread the devices so they don't all poll and publish at once.
+      stagger = min(scan_interval / len(devices), FIRST_POLL_STAGGER)
+      for index, device in enumerate(devices):
+         device.start(index * stagger)
+      _LOGGER.log(timings_level, "Started polling %d meetstekker(s) in %.1f ms",
+                  len(devices), (time.monotonic() - start) * 1000)
+
+   async def async_stop_aurum(event):
+      """Stop polling, cancel fetches that are still in flight and close the MQTT connection."""
+      for device in devices:
+         device.stop()
+         await hass.async_add_executor_job(device.close)
+      if mqtt_client is not None:
+         await mqtt_client.async_stop()
+
+   if hass.is_running:
+      hass.async_create_task(async_start_aurum(None))
+   else:
+      hass.bus.async_listen_once(EVENT_HOMEASSISTANT_START, async_start_aurum)
+   hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_stop_aurum)
 
+   _LOGGER.log(timings_level, "Set up in %.1f ms", (time.monotonic() - setup_start) * 1000)
    return True
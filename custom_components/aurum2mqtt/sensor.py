@@ -0,0 +1,62 @@
+"""
+Native sensors for the AURUM Meetstekker, used with mode: native.
+
+The meetstekkers are polled by the aurum2mqtt component, which parses
+output.xml once per cycle and hands the typed values to these entities.
+"""
+from homeassistant.components.sensor import SensorEntity
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+
+from . import DOMAIN, SIGNAL_SENSORS, SIGNAL_VALUES, sensor_info
+
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+   """Set up the sensors of every meetstekker, as soon as its selected sensors are known."""
+   if discovery_info is None:
+      return
+   for device in hass.data[DOMAIN]:
+      added = set()
+
+      @callback
+      def add_sensors(tags, device=device, added=added):
+         new = [tag for tag in tags if tag not in added]
+         added.update(new)
+         async_add_entities([AurumSensor(device, tag) for tag in new])
+
+      add_sensors(device.sensors)
+      async_dispatcher_connect(hass, SIGNAL_SENSORS.format(device.prefix), add_sensors)
+
+class AurumSensor(SensorEntity):
+   """A value of output.xml, updated by its meetstekker."""
+
+   _attr_should_poll = False
+
+   def __init__(self, device, tag):
+      tag, name, unit, icon, device_class = sensor_info(tag)
+      self._device = device
+      self._tag = tag
+      self._attr_name = device.prefix + name[len('aurum'):]
+      self._attr_unique_id = '{}_{}_sensor'.format(device.prefix, tag)
+      self._attr_native_unit_of_measurement = unit or None
+      self._attr_icon = icon
+      self._attr_device_class = device_class
+      self._attr_device_info = {
+          'identifiers': {(DOMAIN, device.device_info['identifiers'])},
+          'name': device.device_info['name'],
+          'model': device.device_info['model'],
+          'manufacturer': device.device_info['manufacturer'],
+      }
+      self._set_value(device.values.get(tag))
+
+   def _set_value(self, value):
+      self._attr_native_value = None if value is None else round(value, 2)
+
+   async def async_added_to_hass(self):
+      self.async_on_remove(async_dispatcher_connect(
+          self.hass, SIGNAL_VALUES.format(self._device.prefix), self._values_received))
+
+   @callback
+   def _values_received(self, values):
+      if self._tag in values:
+         self._set_value(values[self._tag])
+         self.async_write_ha_state()
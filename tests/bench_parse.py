@@ -0,0 +1,68 @@
+"""Micro-benchmark of parse_output against building the whole tree first.
+
+Runs both on every fixture that parses and reports the time and the peak
+memory allocated per parse. From the repository root:
+
+   python -m tests.bench_parse
+"""
+import os
+import timeit
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+from custom_components.aurum2mqtt import DEFAULT_SELECT, TIMESTAMP_TAG, parse_output, resolve_select
+
+from .common import FIXTURES, load_fixture
+
+NUMBER = 2000
+REPEAT = 5
+
+def parse_dom(body, select=DEFAULT_SELECT):
+   """The approach parse_output replaced: build the tree, walk it once for the layout and once for the values."""
+   root = ET.fromstring(body)
+   layout = [child.tag for child in root]
+   data = []
+   for child in root:
+      value = child.get('value')
+      try:
+         value = round(float(value), 2)
+      except (TypeError, ValueError):
+         pass
+      data.append((child.tag, value))
+   return layout, dict(data[index] for index in select if index < len(data))
+
+def parse_pull(body, tags):
+   """The poll path: parse_output with the selected tags, collecting the layout."""
+   return parse_output(body, tags, [])
+
+def peak_allocated(func, *args):
+   """Return the peak number of bytes allocated by one call."""
+   tracemalloc.start()
+   try:
+      func(*args)
+      return tracemalloc.get_traced_memory()[1]
+   finally:
+      tracemalloc.stop()
+
+def time_per_call(func, *args):
+   """Return the best time of a call in microseconds."""
+   return min(timeit.repeat(lambda: func(*args), number=NUMBER, repeat=REPEAT)) / NUMBER * 1e6
+
+def main():
+   print('{:<28} {:<12} {:>10} {:>12}'.format('fixture', 'parser', 'us/parse', 'peak bytes'))
+   for name in sorted(os.listdir(FIXTURES)):
+      if not name.endswith('.xml'):
+         continue
+      body = load_fixture(name)
+      try:
+         layout = []
+         parse_output(body, layout=layout)
+      except ET.ParseError:
+         continue
+      tags = resolve_select(DEFAULT_SELECT, layout, warn=False) | {TIMESTAMP_TAG}
+      for parser, func, args in (('dom', parse_dom, (body,)), ('pull', parse_pull, (body, tags))):
+         print('{:<28} {:<12} {:>10.1f} {:>12}'.format(
+             name, parser, time_per_call(func, *args), peak_allocated(func, *args)))
+
+if __name__ == '__main__':
+   main()
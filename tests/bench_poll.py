@@ -0,0 +1,103 @@
+"""Benchmark of the fetch, parse and publish path of N devices.
+
+Sets the component up in a bare Home Assistant against local meetstekker
+stand-ins and the in-process broker, then drives the poll cycle of every
+device at the given tick rate. Reports the cycles per second, the p50/p99
+cycle latency, how long the event loop was blocked and the broker connections
+that were opened. From the repository root:
+
+   python -m tests.bench_poll --devices 10 --ticks 200 --rate 0
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+
+from custom_components.aurum2mqtt import FIRST_POLL_STAGGER
+
+from .fake_aurum import MODES, FakeAurum
+from .fake_broker import FakeBroker
+from .harness import async_start_aurum
+
+# The loop lag is sampled this often, lag beyond BLOCKED counts as blocked.
+LAG_INTERVAL = 0.001
+BLOCKED = 0.001
+
+def percentile(samples, fraction):
+   ordered = sorted(samples)
+   return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] if ordered else 0
+
+async def monitor_lag(lags):
+   """Record how late every LAG_INTERVAL sleep wakes up."""
+   loop = asyncio.get_running_loop()
+   while True:
+      start = loop.time()
+      await asyncio.sleep(LAG_INTERVAL)
+      lags.append(max(loop.time() - start - LAG_INTERVAL, 0))
+
+async def timed_poll(device, latencies):
+   start = time.perf_counter()
+   await device.async_poll()
+   latencies.append(time.perf_counter() - start)
+
+async def async_run(args):
+   broker = FakeBroker()
+   await broker.async_start()
+   servers = [FakeAurum(args.mode, delay=args.delay) for _ in range(args.devices)]
+   for server in servers:
+      await server.async_start()
+   with tempfile.TemporaryDirectory() as config_dir:
+      start = time.perf_counter()
+      # A long scan interval keeps the component's own timer out of the way after the first poll.
+      hass, devices = await async_start_aurum(
+          config_dir, servers, broker, scan_interval=3600, timeout=args.timeout, max_parallel=args.max_parallel)
+      try:
+         # The first polls of the devices are staggered.
+         await broker.async_wait(
+             lambda: all(broker.published(device.state_topic) for device in devices),
+             timeout=FIRST_POLL_STAGGER * args.devices + args.timeout + 10)
+         startup = time.perf_counter() - start
+      except asyncio.TimeoutError:
+         # Failing modes never publish a state.
+         startup = None
+
+      latencies, lags = [], []
+      lag_task = asyncio.create_task(monitor_lag(lags))
+      start = time.perf_counter()
+      for tick in range(args.ticks):
+         await asyncio.gather(*(timed_poll(device, latencies) for device in devices))
+         if args.rate:
+            await asyncio.sleep(max(start + (tick + 1) / args.rate - time.perf_counter(), 0))
+      elapsed = time.perf_counter() - start
+      lag_task.cancel()
+      await hass.async_stop()
+
+   for server in servers:
+      await server.async_stop()
+   await broker.async_stop()
+
+   print('devices {}, ticks {}, mode {}, rate {}'.format(
+       args.devices, args.ticks, args.mode, args.rate or 'unlimited'))
+   if startup is not None:
+      print('startup until every device published    {:10.1f} ms'.format(startup * 1000))
+   print('cycles/sec                              {:10.1f}'.format(len(latencies) / elapsed))
+   print('cycle latency p50                       {:10.2f} ms'.format(percentile(latencies, 0.5) * 1000))
+   print('cycle latency p99                       {:10.2f} ms'.format(percentile(latencies, 0.99) * 1000))
+   print('event loop blocked, total               {:10.1f} ms'.format(sum(lag for lag in lags if lag > BLOCKED) * 1000))
+   print('event loop blocked, longest             {:10.2f} ms'.format(max(lags, default=0) * 1000))
+   print('broker connections opened               {:10d}'.format(broker.connections))
+   print('messages published                      {:10d}'.format(len(broker.messages)))
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+   parser.add_argument('--devices', type=int, default=10)
+   parser.add_argument('--ticks', type=int, default=200)
+   parser.add_argument('--rate', type=float, default=0, help='ticks per second, 0 for as fast as possible')
+   parser.add_argument('--mode', choices=MODES, default='synthetic')
+   parser.add_argument('--delay', type=float, default=0.5, help='response delay of the slow mode in seconds')
+   parser.add_argument('--timeout', type=int, default=5)
+   parser.add_argument('--max-parallel', type=int, default=4)
+   asyncio.run(async_run(parser.parse_args()))
+
+if __name__ == '__main__':
+   main()
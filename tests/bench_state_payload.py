@@ -0,0 +1,48 @@
+"""Benchmark of state_payload against the string-replace serializer it replaced.
+
+Both serialize the values of every fixture that parses. From the repository
+root:
+
+   python -m tests.bench_state_payload
+"""
+import json
+import os
+import timeit
+import xml.etree.ElementTree as ET
+
+from custom_components.aurum2mqtt import parse_output, state_payload
+
+from .common import FIXTURES, load_fixture
+
+NUMBER = 5000
+REPEAT = 5
+
+def legacy_state_payload(values):
+   """The previous path: one json.dumps per value, quotes stripped, brackets swapped for braces."""
+   data = []
+   for parameter, value in values.items():
+      try:
+         value = str(round(float(value), 2))
+      except (TypeError, ValueError):
+         pass
+      j_str = json.dumps({parameter: value})
+      j_str = j_str.replace('{"', '').replace('"}', '').replace('"', '')
+      data.append(j_str)
+   mqtt_message = json.dumps(data)
+   return mqtt_message.replace('[', '{').replace(']', '}').replace(': ', '":"')
+
+def main():
+   print('{:<28} {:<10} {:>12} {:>8}'.format('fixture', 'builder', 'us/payload', 'bytes'))
+   for name in sorted(os.listdir(FIXTURES)):
+      if not name.endswith('.xml'):
+         continue
+      try:
+         values = parse_output(load_fixture(name))
+      except ET.ParseError:
+         continue
+      for builder, func in (('legacy', legacy_state_payload), ('single', state_payload)):
+         seconds = min(timeit.repeat(lambda: func(values), number=NUMBER, repeat=REPEAT)) / NUMBER
+         print('{:<28} {:<10} {:>12.1f} {:>8}'.format(name, builder, seconds * 1e6, len(func(values))))
+
+if __name__ == '__main__':
+   main()
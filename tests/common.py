@@ -0,0 +1,12 @@
+"""Helpers shared by the tests and benchmarks."""
+import os
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def fixture_path(name):
+   return os.path.join(FIXTURES, name)
+
+def load_fixture(name):
+   """Return the raw bytes of a fixture file."""
+   with open(fixture_path(name), 'rb') as file:
+      return file.read()
@@ -0,0 +1,34 @@
+"""Fixtures with the local stand-ins for a meetstekker and the MQTT broker."""
+import pytest_asyncio
+
+from .fake_aurum import FakeAurum
+from .fake_broker import FakeBroker
+from .harness import async_start_aurum
+
+@pytest_asyncio.fixture
+async def broker():
+   broker = FakeBroker()
+   await broker.async_start()
+   yield broker
+   await broker.async_stop()
+
+@pytest_asyncio.fixture
+async def aurum():
+   server = FakeAurum()
+   await server.async_start()
+   yield server
+   await server.async_stop()
+
+@pytest_asyncio.fixture
+async def start_aurum(tmp_path, broker, aurum):
+   """Return a coroutine function that starts the component with the given options for the aurum fixture."""
+   started = []
+
+   async def start(**options):
+      hass, devices = await async_start_aurum(str(tmp_path), [aurum], broker, **options)
+      started.append(hass)
+      return hass, devices[0]
+
+   yield start
+   for hass in started:
+      await hass.async_stop()
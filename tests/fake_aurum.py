@@ -0,0 +1,98 @@
+"""Local stand-in for the /measurements/output.xml page of a meetstekker."""
+import asyncio
+import math
+import time
+import xml.etree.ElementTree as ET
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from custom_components.aurum2mqtt import SENSORS, TIMESTAMP_TAG, TELEGRAM_INTERVAL
+
+from .common import load_fixture
+
+MODES = ('recorded', 'synthetic', 'slow', 'truncated', 'reordered')
+
+def reorder(body):
+   """Return output.xml with its tags in reverse order."""
+   root = ET.fromstring(body)
+   children = list(root)
+   for child in children:
+      root.remove(child)
+   root.extend(reversed(children))
+   return ET.tostring(root, encoding='UTF-8')
+
+def synthetic_output(request, telegram=None):
+   """Return an output.xml with every known sensor for the given request number.
+
+   Power values swing around, counters rise slowly and the smart meter
+   timestamp is the telegram time in the DSMR form, left out when None.
+   """
+   lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<output>']
+   for index, (tag, _, unit, _, device_class) in enumerate(SENSORS):
+      if tag == TIMESTAMP_TAG:
+         if telegram is None:
+            continue
+         value = time.strftime('%y%m%d%H%M%S', time.localtime(telegram))
+      elif device_class == 'power':
+         value = '{:.6f}'.format(1000 * math.sin(request / 10 + index))
+      else:
+         value = '{:.6f}'.format(1000 + index + request / 1000)
+      lines.append('\t<{} value="{}" unit="{}"/>'.format(tag, value, unit))
+   lines.append('</output>')
+   return '\n'.join(lines).encode()
+
+class FakeAurum:
+   """Serves output.xml on a local port, shaped by mode.
+
+   recorded serves a fixture as is, synthetic a generated document with a new
+   telegram on every request (timestamps=False leaves the smart meter out),
+   slow the fixture after delay seconds, truncated the first half of the
+   fixture and reordered the fixture with its tags in reverse order. The mode
+   can be changed while the server runs.
+   """
+
+   def __init__(self, mode='recorded', fixture='output.xml', delay=5, timestamps=True):
+      self.mode = mode
+      self.delay = delay
+      self.timestamps = timestamps
+      self.requests = 0
+      self._body = load_fixture(fixture)
+      self._telegram = time.time() // TELEGRAM_INTERVAL * TELEGRAM_INTERVAL
+      self._server = None
+
+   def load(self, fixture):
+      """Serve another fixture from now on."""
+      self._body = load_fixture(fixture)
+
+   @property
+   def host(self):
+      """The host option of a device polling this server."""
+      return '127.0.0.1:{}'.format(self._server.port)
+
+   async def async_start(self):
+      app = web.Application()
+      app.router.add_get('/measurements/output.xml', self._handle)
+      self._server = TestServer(app, host='127.0.0.1')
+      await self._server.start_server()
+
+   async def async_stop(self):
+      await self._server.close()
+
+   def body(self):
+      """Return the body of the next response."""
+      self.requests += 1
+      if self.mode == 'synthetic':
+         self._telegram += TELEGRAM_INTERVAL
+         return synthetic_output(self.requests, self._telegram if self.timestamps else None)
+      if self.mode == 'truncated':
+         return self._body[:len(self._body) // 2]
+      if self.mode == 'reordered':
+         return reorder(self._body)
+      return self._body
+
+   async def _handle(self, request):
+      body = self.body()
+      if self.mode == 'slow':
+         await asyncio.sleep(self.delay)
+      return web.Response(body=body, content_type='text/xml')
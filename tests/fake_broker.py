@@ -0,0 +1,153 @@
+"""In-process MQTT 3.1.1 broker stand-in that records every publish."""
+import asyncio
+import collections
+import struct
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK = range(1, 10)
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+Message = collections.namedtuple('Message', 'topic payload qos retain')
+
+def packet(kind, body=b'', flags=0):
+   """Frame a control packet with its remaining length."""
+   header = bytearray([kind << 4 | flags])
+   length = len(body)
+   while True:
+      byte, length = length % 128, length // 128
+      header.append(byte | 0x80 if length else byte)
+      if not length:
+         return bytes(header) + body
+
+def encode_string(value):
+   return struct.pack('!H', len(value)) + value
+
+class FakeBroker:
+   """Accepts MQTT clients on a local port and keeps what they publish.
+
+   Handles the packets the component uses: CONNECT, SUBSCRIBE with exact
+   topics, PUBLISH with QoS 0, 1 and 2, PINGREQ and DISCONNECT. Messages are
+   recorded in order, retained ones are also kept per topic and delivered to
+   new subscribers. With ack False QoS 1 publishes are not acknowledged, with
+   accepting False new connections are closed right away, which together with
+   async_drop_clients simulates an outage.
+   """
+
+   def __init__(self):
+      self.messages = []
+      self.retained = {}
+      self.connections = 0
+      self.ack = True
+      self.accepting = True
+      self._clients = {}
+      self._server = None
+      self._received = asyncio.Condition()
+
+   @property
+   def port(self):
+      return self._server.sockets[0].getsockname()[1]
+
+   async def async_start(self):
+      self._server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+
+   async def async_stop(self):
+      await self.async_drop_clients()
+      self._server.close()
+      await self._server.wait_closed()
+
+   async def async_drop_clients(self):
+      """Close the connections of all clients, as when the broker goes down."""
+      for writer in list(self._clients):
+         writer.close()
+      self._clients.clear()
+
+   def published(self, topic):
+      """Return the payloads published to topic, oldest first."""
+      return [message.payload for message in self.messages if message.topic == topic]
+
+   async def async_wait(self, predicate, timeout=5):
+      """Wait until predicate() is true, checking after every publish."""
+      async with self._received:
+         await asyncio.wait_for(self._received.wait_for(predicate), timeout)
+
+   async def async_publish(self, topic, payload, retain=False):
+      """Send a message to the clients subscribed to topic, e.g. the HA birth message."""
+      if isinstance(payload, str):
+         payload = payload.encode()
+      await self._deliver(Message(topic, payload, 0, retain))
+
+   async def _deliver(self, message):
+      if message.retain:
+         if message.payload:
+            self.retained[message.topic] = message
+         else:
+            self.retained.pop(message.topic, None)
+      for writer, topics in self._clients.items():
+         if message.topic in topics:
+            writer.write(packet(PUBLISH, encode_string(message.topic.encode()) + message.payload))
+
+   async def _serve(self, reader, writer):
+      if not self.accepting:
+         writer.close()
+         return
+      try:
+         while True:
+            first = (await reader.readexactly(1))[0]
+            length, shift = 0, 0
+            while True:
+               byte = (await reader.readexactly(1))[0]
+               length |= (byte & 0x7f) << shift
+               shift += 7
+               if not byte & 0x80:
+                  break
+            body = await reader.readexactly(length)
+            if not await self._handle(first >> 4, first & 0x0f, body, writer):
+               break
+      except (asyncio.IncompleteReadError, ConnectionError):
+         pass
+      finally:
+         self._clients.pop(writer, None)
+         writer.close()
+
+   async def _handle(self, kind, flags, body, writer):
+      """Answer one packet, returning False when the client disconnects."""
+      if kind == CONNECT:
+         self.connections += 1
+         self._clients[writer] = set()
+         writer.write(packet(CONNACK, b'\x00\x00'))
+      elif kind == PUBLISH:
+         qos, retain = flags >> 1 & 3, bool(flags & 1)
+         size = struct.unpack_from('!H', body)[0]
+         topic = body[2:2 + size].decode()
+         offset = 2 + size
+         if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            if qos == 2:
+               writer.write(packet(PUBREC, packet_id))
+            elif self.ack:
+               writer.write(packet(PUBACK, packet_id))
+         message = Message(topic, body[offset:], qos, retain)
+         async with self._received:
+            self.messages.append(message)
+            self._received.notify_all()
+         await self._deliver(message)
+      elif kind == PUBREL:
+         writer.write(packet(PUBCOMP, body[:2]))
+      elif kind == SUBSCRIBE:
+         packet_id, offset, topics = body[:2], 2, []
+         while offset < len(body):
+            size = struct.unpack_from('!H', body, offset)[0]
+            topics.append(body[offset + 2:offset + 2 + size].decode())
+            offset += 2 + size + 1
+         self._clients.setdefault(writer, set()).update(topics)
+         writer.write(packet(SUBACK, packet_id + bytes(len(topics))))
+         for topic in topics:
+            if topic in self.retained:
+               retained = self.retained[topic]
+               writer.write(packet(PUBLISH, encode_string(topic.encode()) + retained.payload, flags=1))
+      elif kind == PINGREQ:
+         writer.write(packet(PINGRESP))
+      elif kind == DISCONNECT:
+         return False
+      await writer.drain()
+      return True
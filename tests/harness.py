@@ -0,0 +1,52 @@
+"""Runs the component in a bare Home Assistant against the local stand-ins."""
+import os
+
+from homeassistant import config_entries, loader
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers import area_registry, device_registry, entity_registry
+from homeassistant.setup import async_setup_component
+
+from custom_components.aurum2mqtt import CONFIG_SCHEMA, DOMAIN, async_setup
+
+def device_config(servers):
+   """Return the device list for the FakeAurum servers, named meter0, meter1, ..."""
+   return [{'host': server.host, 'name': 'meter{}'.format(index)} for index, server in enumerate(servers)]
+
+async def async_start_aurum(config_dir, servers, broker, **options):
+   """Set up the component for the FakeAurum servers and the FakeBroker, and start HA.
+
+   The devices are named meter0, meter1, ... so their state topics are
+   aurum/meter<n>/sensors. Returns hass and the devices.
+   """
+   os.makedirs(os.path.join(config_dir, '.storage'), exist_ok=True)
+   hass = HomeAssistant(config_dir)
+   config = CONFIG_SCHEMA({DOMAIN: dict({
+       'device': device_config(servers),
+       'broker': '127.0.0.1',
+       'port': broker.port,
+       'username': 'user',
+       'password': 'password',
+   }, **options)})
+   assert await async_setup(hass, config)
+   await hass.async_start()
+   return hass, hass.data[DOMAIN]
+
+async def async_setup_native(config_dir, servers, **options):
+   """Set up the component in native mode the way HA loads it, through its manifest, and start HA.
+
+   Only the parts of HA the sensor platform needs are loaded. Returns hass and the devices.
+   """
+   os.makedirs(os.path.join(config_dir, '.storage'), exist_ok=True)
+   hass = HomeAssistant(config_dir)
+   # paho-mqtt from the manifest is installed with the test requirements.
+   hass.config.skip_pip = True
+   loader.async_setup(hass)
+   await area_registry.async_load(hass)
+   await device_registry.async_load(hass)
+   await entity_registry.async_load(hass)
+   hass.config_entries = config_entries.ConfigEntries(hass, {})
+   await hass.config_entries.async_initialize()
+   config = {DOMAIN: dict({'mode': 'native', 'device': device_config(servers)}, **options)}
+   assert await async_setup_component(hass, DOMAIN, config)
+   await hass.async_start()
+   return hass, hass.data[DOMAIN]
@@ -0,0 +1,43 @@
+"""Tests of the windowed aggregates of the power sensors."""
+import pytest
+
+from custom_components.aurum2mqtt import Aggregate, Aggregator
+
+def feed(aggregate, samples):
+   """Add (t, value) samples, returning the summaries of the windows they closed."""
+   return [summary for summary in (aggregate.add(t, value) for t, value in samples) if summary is not None]
+
+def test_constant_power():
+   summaries = feed(Aggregate(60), [(t, 1200.0) for t in range(0, 130, 10)])
+   assert summaries == [{'min': 1200.0, 'max': 1200.0, 'mean': 1200.0, 'energy': 20.0}] * 2
+
+def test_boundary_value_counts_for_both_windows():
+   aggregate = Aggregate(60)
+   # 0 W until a 6000 W load shows up just after the boundary.
+   summaries = feed(aggregate, [(t, 0.0) for t in range(0, 60, 10)] + [(61, 6000.0)])
+   boundary = 6000 * 10 / 11
+   assert summaries == [{
+       'min': 0.0, 'max': round(boundary, 2), 'mean': round(boundary * 10 / 2 / 60, 2),
+       'energy': round(boundary * 10 / 2 / 3600, 3)}]
+   summaries = feed(aggregate, [(t, 6000.0) for t in range(70, 130, 10)])
+   assert summaries[0]['min'] == round(boundary, 2)
+   assert summaries[0]['max'] == 6000.0
+   assert summaries[0]['mean'] == pytest.approx(6000 - (6000 - boundary) / 2 / 60, abs=0.01)
+
+def test_gap_is_not_interpolated():
+   summaries = feed(Aggregate(60), [(0, 100.0), (30, 300.0), (200, 5000.0)])
+   assert summaries == [{'min': 100.0, 'max': 300.0, 'mean': 200.0, 'energy': round(200 * 30 / 3600, 3)}]
+
+def test_old_samples_are_ignored():
+   aggregate = Aggregate(60)
+   feed(aggregate, [(0, 100.0), (30, 100.0)])
+   assert aggregate.add(20, 9000.0) is None
+   assert feed(aggregate, [(60, 100.0)])[0]['max'] == 100.0
+
+def test_aggregator_only_takes_power_sensors():
+   aggregator = Aggregator([1])
+   for t in (0, 30):
+      assert aggregator.add(t, {'powerMain': 500.0, 'counterGas': 1000.0, 'powerSolar': None}) == {}
+   closed = aggregator.add(60, {'powerMain': 500.0, 'counterGas': 1000.0})
+   assert list(closed) == [1]
+   assert list(closed[1]) == ['powerMain']
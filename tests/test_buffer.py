@@ -0,0 +1,42 @@
+"""Tests of the reading buffer behind the backfill."""
+from custom_components.aurum2mqtt import RingBuffer
+
+TAGS = ('powerMain', 'counterGas')
+
+def reading(number):
+   return {'powerMain': float(number), 'counterGas': 1000.0 + number}
+
+def open_buffer(tmp_path, capacity=8):
+   buffer = RingBuffer(str(tmp_path / 'buffer'), capacity, TAGS)
+   buffer.open()
+   return buffer
+
+def test_live_readings_are_not_backfilled(tmp_path):
+   buffer = open_buffer(tmp_path)
+   for number, pending in enumerate((True, True, False, True, False)):
+      buffer.append(number, reading(number), pending)
+   assert buffer.pending == 3
+   assert [timestamp for timestamp, _ in buffer.peek_pending(10)] == [0, 1, 3]
+   buffer.mark_sent(2)
+   assert buffer.peek_pending(10) == [(3, reading(3))]
+   assert buffer.last() == (4, reading(4))
+
+def test_pending_readings_survive_a_restart(tmp_path):
+   buffer = open_buffer(tmp_path)
+   for number in range(3):
+      buffer.append(number, reading(number), number != 1)
+   buffer.mark_sent(1)
+   buffer.close()
+   buffer = open_buffer(tmp_path)
+   assert buffer.peek_pending(10) == [(2, reading(2))]
+
+def test_overwritten_readings_are_no_longer_pending(tmp_path):
+   buffer = open_buffer(tmp_path, capacity=4)
+   for number in range(6):
+      buffer.append(number, reading(number), number % 2 == 0)
+   assert buffer.pending == 2
+   assert [timestamp for timestamp, _ in buffer.peek_pending(10)] == [2, 4]
+   for number in range(6, 10):
+      buffer.append(number, reading(number), True)
+   assert buffer.pending == 4
+   assert [timestamp for timestamp, _ in buffer.peek_pending(10)] == [6, 7, 8, 9]
@@ -0,0 +1,24 @@
+"""Tests of the native mode, set up through the manifest like HA does."""
+import asyncio
+
+import pytest
+
+from .harness import async_setup_native
+
+ENTITY_ID = 'sensor.aurum_meter0_main_power'
+
+@pytest.mark.asyncio
+async def test_native_sensors_get_the_values(tmp_path, aurum):
+   hass, _ = await async_setup_native(str(tmp_path), [aurum])
+   try:
+      for _ in range(100):
+         await hass.async_block_till_done()
+         if hass.states.get(ENTITY_ID) is not None:
+            break
+         await asyncio.sleep(0.05)
+      state = hass.states.get(ENTITY_ID)
+      assert state is not None
+      assert float(state.state) == -1203.0
+      assert state.attributes['unit_of_measurement'] == 'W'
+   finally:
+      await hass.async_stop()
@@ -0,0 +1,53 @@
+"""Tests of the output.xml parser."""
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import custom_components.aurum2mqtt as aurum
+from custom_components.aurum2mqtt import DEFAULT_SELECT, SENSORS, parse_output, resolve_select
+
+from .common import load_fixture
+
+def test_reads_every_tag_in_document_order():
+   layout = []
+   values = parse_output(load_fixture('output.xml'), layout=layout)
+   assert layout == [row[0] for row in SENSORS]
+   assert list(values) == layout
+   assert values['powerSolar'] == 1834.225586
+   assert values['powerMain'] == -1203.0
+   assert values['smartMeterTimestamp'] == 201018084910
+
+def test_reads_only_the_selected_tags():
+   layout = []
+   values = parse_output(load_fixture('output.xml'), {'powerMain', 'counterGas'}, layout)
+   assert values == {'powerMain': -1203.0, 'counterGas': 2345.678}
+   assert len(layout) == len(SENSORS)
+
+def test_non_numeric_values_map_to_none():
+   values = parse_output(b'<output><powerMain value="n/a"/><powerSolar/></output>')
+   assert values == {'powerMain': None, 'powerSolar': None}
+
+def test_nan_and_inf_map_to_none():
+   values = parse_output(load_fixture('output_nonfinite.xml'))
+   assert values.pop('powerElectricity') == 631.225586
+   assert set(values.values()) == {None}
+
+@pytest.mark.parametrize('chunk', [1, 7, 64, 100000])
+def test_result_does_not_depend_on_chunk_size(monkeypatch, chunk):
+   body = load_fixture('output.xml')
+   expected = parse_output(body)
+   monkeypatch.setattr(aurum, 'PARSE_CHUNK', chunk)
+   assert parse_output(body) == expected
+
+def test_truncated_body_raises():
+   body = load_fixture('output.xml')
+   with pytest.raises(ET.ParseError):
+      parse_output(body[:len(body) // 2])
+
+def test_select_warns_about_missing_sensors(caplog):
+   assert resolve_select(['powerMain', 'counterGas', 5], ('powerMain', 'powerSolar')) == {'powerMain'}
+   assert len(caplog.records) == 2
+
+def test_default_select_does_not_warn(caplog):
+   assert resolve_select(DEFAULT_SELECT, ('powerMain', 'powerSolar'), warn=False) == {'powerMain', 'powerSolar'}
+   assert not caplog.records
@@ -0,0 +1,110 @@
+"""Tests of the poll cycle against the local meetstekker and broker stand-ins."""
+import asyncio
+import json
+import time
+
+import pytest
+
+from custom_components.aurum2mqtt import (
+    BACKFILL_TOPIC, DIAGNOSTICS_TOPIC, DISCOVERY_TOPIC, TELEGRAM_INTERVAL, AurumMqttClient, CycleStats,
+    PollScheduler, parse_output, state_payload)
+
+from .common import load_fixture
+
+STATE_TOPIC = 'aurum/meter0/sensors'
+
+def state(broker):
+   """Return the last state message, decoded."""
+   return json.loads(broker.published(STATE_TOPIC)[-1])
+
+def test_aligned_polls_keep_the_device_offset():
+   schedulers = [PollScheduler(TELEGRAM_INTERVAL) for _ in range(2)]
+   schedulers[1].offset = 2
+   telegram = time.time() // TELEGRAM_INTERVAL * TELEGRAM_INTERVAL
+   started = telegram + 3
+   for _ in range(3):
+      delays = [scheduler.polled(started + scheduler.offset, telegram)[1] for scheduler in schedulers]
+      assert delays[1] - delays[0] == pytest.approx(2, abs=0.05)
+      telegram += TELEGRAM_INTERVAL
+      started += TELEGRAM_INTERVAL
+
+@pytest.mark.asyncio
+async def test_first_poll_sends_discovery_and_state(broker, start_aurum):
+   await start_aurum(buffer_size=0)
+   await broker.async_wait(lambda: broker.published(STATE_TOPIC))
+   values = parse_output(load_fixture('output.xml'))
+   assert broker.published(STATE_TOPIC) == [state_payload(values).encode()]
+   config = json.loads(broker.retained[DISCOVERY_TOPIC.format('aurum_meter0', 'powerMain')].payload)
+   assert config['state_topic'] == STATE_TOPIC
+   assert broker.connections == 1
+
+@pytest.mark.asyncio
+async def test_connections_are_counted_once_for_all_devices(broker, start_aurum):
+   await start_aurum(buffer_size=0)
+   topic = DIAGNOSTICS_TOPIC.format(STATE_TOPIC)
+   await broker.async_wait(lambda: broker.published(topic))
+   assert json.loads(broker.retained['aurum/diagnostics'].payload) == {'mqtt_connections': 1}
+   assert 'mqtt_connections' not in json.loads(broker.published(topic)[-1])
+
+def test_dropped_messages_count_for_their_device():
+   client = AurumMqttClient(None, 'localhost', 1883, {'username': None, 'password': None}, None, 60, 1)
+   first, second = CycleStats(), CycleStats()
+   client.publish('aurum/first/sensors', '1', stats=first)
+   client.publish('aurum/second/sensors', '2', stats=second)
+   assert first.counters['publish_failures'] == 1
+   assert second.counters['publish_failures'] == 0
+   assert first.counters['bytes_sent'] == second.counters['bytes_sent'] == 0
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('mode', ['slow', 'truncated'])
+async def test_failed_fetch_publishes_nothing_and_recovers(broker, aurum, start_aurum, mode):
+   aurum.mode = mode
+   aurum.delay = 2
+   _, device = await start_aurum(buffer_size=0, timeout=1)
+   await device.async_poll()
+   assert not broker.published(STATE_TOPIC)
+   aurum.mode = 'recorded'
+   await device.async_poll()
+   await broker.async_wait(lambda: broker.published(STATE_TOPIC))
+
+@pytest.mark.asyncio
+async def test_reordered_tags_keep_their_values(broker, aurum, start_aurum):
+   _, device = await start_aurum(buffer_size=0)
+   await broker.async_wait(lambda: broker.published(STATE_TOPIC))
+   sent = len(broker.messages)
+   aurum.load('output_next.xml')
+   aurum.mode = 'reordered'
+   await device.async_poll()
+   await broker.async_wait(lambda: len(broker.published(STATE_TOPIC)) == 2)
+   values = parse_output(load_fixture('output_next.xml'))
+   assert {tag: state(broker)[tag] for tag in ('powerSolar', 'powerMain', 'counterOutSolar')} == {
+       'powerSolar': 1840.5, 'powerMain': -1210.0, 'counterOutSolar': round(values['counterOutSolar'], 2)}
+   # Only the state is new, the discovery configs did not change.
+   assert len(broker.messages) == sent + 1
+
+@pytest.mark.asyncio
+async def test_missing_value_keeps_retained_sensor_topic(broker, aurum, start_aurum):
+   aurum.load('output_unavailable.xml')
+   await start_aurum(buffer_size=0, encoding='scalar')
+   await broker.async_wait(lambda: broker.published(STATE_TOPIC + '/powerMain'))
+   assert not broker.published(STATE_TOPIC + '/rateGas')
+
+@pytest.mark.asyncio
+async def test_readings_during_an_outage_are_backfilled(broker, aurum, start_aurum):
+   aurum.mode = 'synthetic'
+   _, device = await start_aurum()
+   await broker.async_wait(lambda: broker.published(STATE_TOPIC))
+   broker.accepting = False
+   await broker.async_drop_clients()
+   while device._mqtt.connected:
+      await asyncio.sleep(0.05)
+   for _ in range(3):
+      await device.async_poll()
+   broker.accepting = True
+   await broker.async_wait(lambda: broker.published(BACKFILL_TOPIC.format(STATE_TOPIC)), timeout=10)
+   readings = json.loads(broker.published(BACKFILL_TOPIC.format(STATE_TOPIC))[0])
+   assert len(readings) == 3
+   assert broker.connections == 2
+   # The readings taken during the outage were published live as well, once the broker was back.
+   await broker.async_wait(lambda: len(broker.published(STATE_TOPIC)) == 4)
+   assert state(broker)['smartMeterTimestamp'] == readings[-1]['smartMeterTimestamp']
@@ -0,0 +1,30 @@
+"""Golden-file tests of the JSON state message."""
+import json
+
+import pytest
+
+from custom_components.aurum2mqtt import parse_output, state_payload
+
+from .common import load_fixture
+
+GOLDEN = json.loads(load_fixture('state_payload.json'))
+
+def case_values(case):
+   if 'fixture' in case:
+      return parse_output(load_fixture(case['fixture']))
+   return case['values']
+
+@pytest.mark.parametrize('case', GOLDEN, ids=[case['name'] for case in GOLDEN])
+def test_matches_golden_payload(case):
+   assert state_payload(case_values(case)) == case['payload']
+
+@pytest.mark.parametrize('case', GOLDEN, ids=[case['name'] for case in GOLDEN])
+def test_payload_is_valid_json_with_numeric_values(case):
+   values = case_values(case)
+   decoded = json.loads(state_payload(values))
+   assert list(decoded) == list(values)
+   for tag, value in values.items():
+      if value is None:
+         assert decoded[tag] is None
+      else:
+         assert decoded[tag] == round(value, 2)
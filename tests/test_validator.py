@@ -0,0 +1,43 @@
+"""Tests of the plausibility rules."""
+from custom_components.aurum2mqtt import CONFIRM_SAMPLES, SEED_TOLERANCE, Validator
+
+def validator():
+   return Validator(max_counter_rate=50, max_power=50000, limits={})
+
+def test_counter_of_zero_is_rejected_once_it_has_a_level():
+   checker = validator()
+   # An unused input.
+   assert checker.check(0, {'counterGas': 0.0}) == {'counterGas': 0.0}
+   assert checker.check(10, {'counterGas': 2345.678}) == {'counterGas': 2345.678}
+   for t in range(20, 20 + 10 * (CONFIRM_SAMPLES + 2), 10):
+      assert checker.check(t, {'counterGas': 0.0}) == {'counterGas': 2345.678}
+   assert checker.rejected == CONFIRM_SAMPLES + 2
+
+def test_seeded_baseline_rejects_a_bad_first_reading():
+   checker = validator()
+   checker.seed(0, {'counterGas': 2345.678, 'counterOutSolar': 0.0, 'powerMain': 100.0})
+   assert checker.check(10, {'counterGas': 12.5}) == {'counterGas': 2345.678}
+   assert checker.check(20, {'counterGas': 2345.679}) == {'counterGas': 2345.679}
+   assert checker.check(30, {'counterOutSolar': 0.0}) == {'counterOutSolar': 0.0}
+   assert checker.check(40, {'counterGas': 0.0}) == {'counterGas': 2345.679}
+
+def test_rounded_seed_allows_the_rounding():
+   checker = validator()
+   checker.seed(0, {'counterGas': 2345.68}, SEED_TOLERANCE)
+   assert checker.check(10, {'counterGas': 2345.678}) == {'counterGas': 2345.678}
+   # The tolerance only applies to the seeded baseline.
+   assert checker.check(20, {'counterGas': 2345.677}) == {'counterGas': 2345.678}
+   assert checker.check(30, {'counterGas': 2345.67}) == {'counterGas': 2345.678}
+
+def test_consistent_new_level_is_accepted_after_confirmation():
+   checker = validator()
+   checker.check(0, {'counterGas': 2345.678})
+   for sample in range(CONFIRM_SAMPLES - 1):
+      assert checker.check(10 * (sample + 1), {'counterGas': 3.0}) == {'counterGas': 2345.678}
+   assert checker.check(10 * CONFIRM_SAMPLES, {'counterGas': 3.0}) == {'counterGas': 3.0}
+
+def test_power_outside_bounds_keeps_last_value():
+   checker = validator()
+   assert checker.check(0, {'powerMain': -1203.0}) == {'powerMain': -1203.0}
+   assert checker.check(10, {'powerMain': 99999.0}) == {'powerMain': -1203.0}
+   assert checker.check(20, {'powerMain': None}) == {'powerMain': -1203.0}